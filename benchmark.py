@@ -0,0 +1,769 @@
+import argparse
+import asyncio
+import contextlib
+import gzip
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+import aiohttp
+import aiosqlite
+from aiohttp import web
+
+import solid
+
+
+def build_tree(media, paths, dirs, files):
+    for i in range(dirs):
+        folder = os.path.join(
+            media, unquote(paths[i % len(paths)]), f"show {i}", f"Season {i % 4}"
+        )
+        os.makedirs(folder, exist_ok=True)
+        for j in range(files):
+            with open(os.path.join(folder, f"episode {j}.nfo"), "w") as f:
+                f.write("x" * (j + 1))
+
+
+def autoindex_page(path, entries):
+    # Same layout as nginx autoindex: names padded to 50 columns, then date and size
+    rows = [
+        f"<html>\r\n<head><title>Index of {path}</title></head>\r\n<body>\r\n"
+        f'<h1>Index of {path}</h1><hr><pre><a href="../">../</a>\r\n'
+    ]
+    for name, is_dir, mtime, size in entries:
+        if is_dir:
+            name += "/"
+        label = name if len(name) <= 50 else name[:47] + "..>"
+        date = datetime.fromtimestamp(mtime).strftime("%d-%b-%Y %H:%M")
+        rows.append(
+            f'<a href="{quote(name)}">{label}</a>{" " * max(1, 51 - len(label))}'
+            f'{date} {"-" if is_dir else size:>19}\r\n'
+        )
+    rows.append("</pre><hr></body>\r\n</html>\r\n")
+    return "".join(rows)
+
+
+def synthetic_entries(count, start=1700000000):
+    entries = []
+    for i in range(count):
+        mtime = start + (i % 5000) * 60
+        if i % 10 == 0:
+            entries.append((f"电影 Movie {i} (2024)", True, mtime, 0))
+        else:
+            entries.append(
+                (f"电影 Movie {i} (2024) - 1080p.nfo", False, mtime, 1000 + i)
+            )
+    return entries
+
+
+def slowed_down(visit, latency):
+    # Every readdir and every stat pays one round trip, like on an NFS/SMB mount
+    def visit_directory(media, dirname, known_mtime):
+        result = visit(media, dirname, known_mtime)
+        time.sleep(latency * (1 + len(result[1] or [])))
+        return result
+
+    return visit_directory
+
+
+async def bench_scan(args):
+    media = tempfile.mkdtemp(prefix="emd-scan-")
+    try:
+        build_tree(media, solid.s_paths, args.dirs, args.files)
+        total = args.dirs * args.files
+        print(
+            f"Scanning {total} files in {args.dirs} folders, "
+            f"latency {args.latency * 1000:.1f}ms per call"
+        )
+        print(f"{'workers':>8} {'seconds':>10} {'files/s':>12}")
+        visit = solid.visit_directory
+        if args.latency:
+            solid.visit_directory = slowed_down(visit, args.latency)
+        for workers in args.workers:
+            db = os.path.join(media, ".localfiles.db")
+            if os.path.exists(db):
+                os.remove(db)
+            start = time.perf_counter()
+            await solid.generate_localdb(
+                db, media, solid.s_paths, full=True, workers=workers
+            )
+            elapsed = time.perf_counter() - start
+            print(f"{workers:>8} {elapsed:>10.3f} {total / elapsed:>12.0f}")
+        solid.visit_directory = visit
+    finally:
+        shutil.rmtree(media)
+
+
+async def bench_parse(args):
+    url = "http://127.0.0.1/" + quote("电影/")
+    html = autoindex_page("/电影/", synthetic_entries(args.entries))
+    print(f"Parsing a {len(html) // 1024} KiB listing with {args.entries} entries")
+    print(f"{'parser':>12} {'seconds':>10} {'entries/s':>12}")
+    results = {}
+    for name, parser in (
+        ("autoindex", solid.parse_autoindex),
+        ("soup", solid.parse_soup),
+    ):
+        solid.listing_timestamp.cache_clear()
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            results[name] = parser(url, html)
+        elapsed = (time.perf_counter() - start) / args.rounds
+        print(f"{name:>12} {elapsed:>10.4f} {args.entries / elapsed:>12.0f}")
+    rows = {
+        name: [
+            (file.url, file.filename, file.timestamp, file.filesize) for file in files
+        ]
+        + directories
+        for name, (files, directories) in results.items()
+    }
+    if rows["autoindex"] != rows["soup"]:
+        print("Parsers disagree!")
+
+
+async def parse_all(pages, pool, concurrency):
+    # Like the crawl: many listings in flight, each parsed as soon as its body is in
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def parse_one(url, html):
+        async with semaphore:
+            await asyncio.sleep(0)
+            if pool:
+                return await solid.parse_listing_in_pool(url, html, pool)
+            return solid.parse_listing(url, html)
+
+    await asyncio.gather(*(parse_one(url, html) for url, html in pages))
+
+
+async def bench_pool(args):
+    html = autoindex_page("/电影/", synthetic_entries(args.entries))
+    pages = [
+        ("http://127.0.0.1/" + quote(f"电影/{i}/"), html) for i in range(args.listings)
+    ]
+    print(
+        f"Parsing {args.listings} listings of {len(html) // 1024} KiB "
+        f"with {args.entries} entries on {os.cpu_count()} cores"
+    )
+    print(
+        f"{'workers':>8} {'seconds':>10} {'listings/s':>11} {'entries/s':>12} "
+        f"{'max lag ms':>11}"
+    )
+    for workers in args.workers:
+        pool = solid.create_parse_pool(workers) if workers else None
+        try:
+            if pool:
+                # Spawning the workers is a one-off cost of the run, not of parsing
+                await asyncio.gather(
+                    *(
+                        solid.parse_listing_in_pool(*pages[0], pool)
+                        for _ in range(workers)
+                    )
+                )
+            solid.listing_timestamp.cache_clear()
+            solid.metrics.reset()
+            lag = asyncio.create_task(solid.watch_loop_lag(0.01))
+            start = time.perf_counter()
+            await parse_all(pages, pool, args.concurrency)
+            elapsed = time.perf_counter() - start
+            lag.cancel()
+            lag_seconds = solid.metrics.histograms.get(("loop_lag_seconds", None))
+            worst = lag_seconds.max * 1000 if lag_seconds else 0
+        finally:
+            if pool:
+                pool.shutdown()
+        print(
+            f"{workers:>8} {elapsed:>10.3f} {args.listings / elapsed:>11.0f} "
+            f"{args.listings * args.entries / elapsed:>12.0f} {worst:>11.1f}"
+        )
+
+
+def show_path(show):
+    # As deep and as long as the paths of a real library
+    return f"/每日更新/电视剧/国产剧/Show {show} (2024)/Season 1/"
+
+
+def episode_name(show, episode):
+    return f"Show {show} (2024) S01E{episode:04d} - 2160p.WEB-DL.H265.DDP5.1.nfo"
+
+
+def crawl_rows(rows, per_folder):
+    # One list per crawled folder, the unit store_files() hands over
+    for start in range(0, rows, per_folder):
+        show = start // per_folder
+        path = show_path(show)
+        folder = solid.Folder("http://127.0.0.1" + quote(path), path)
+        files = []
+        for i in range(start, min(rows, start + per_folder)):
+            # Links are never stored, the name stands in for the quoted one
+            name = episode_name(show, i)
+            files.append(solid.RemoteFile(folder, name, name, 1700000000 + i, 1000 + i))
+        yield files
+
+
+async def insert_per_folder(db, rows, per_folder):
+    async with aiosqlite.connect(db) as conn:
+        await conn.execute(
+            "CREATE TABLE files (filename TEXT, timestamp INTEGER NULL, filesize INTEGER NULL)"
+        )
+        for folder in crawl_rows(rows, per_folder):
+            await conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                [(file.filename, file.timestamp, file.filesize) for file in folder],
+            )
+            await conn.commit()
+
+
+async def insert_flat(db, rows, per_folder):
+    # The layout before folder ids, every row keyed by its full path
+    async with aiosqlite.connect(db) as conn:
+        await solid.tune_db(conn)
+        await conn.execute(
+            "CREATE TABLE files (filename TEXT PRIMARY KEY, timestamp INTEGER NULL, filesize INTEGER NULL)"
+        )
+        writer = solid.DBWriter(conn)
+        for folder in crawl_rows(rows, per_folder):
+            await writer.put(
+                [(file.filename, file.timestamp, file.filesize) for file in folder],
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+            )
+        await writer.close()
+
+
+async def insert_batched(db, rows, per_folder):
+    async with aiosqlite.connect(db) as conn:
+        await solid.tune_db(conn)
+        await solid.create_table(conn)
+        writer = solid.DBWriter(conn)
+        for folder in crawl_rows(rows, per_folder):
+            await writer.put_files(folder)
+        await writer.close()
+
+
+def run_insert(insert, db, rows, per_folder, results):
+    # A process of its own per writer, so each peak RSS is its own
+    logging.getLogger("emd").setLevel(logging.ERROR)
+    start = time.perf_counter()
+    asyncio.run(insert(db, rows, per_folder))
+    elapsed = time.perf_counter() - start
+    results.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def listing_kib(entries, records):
+    # What one parsed listing holds on to, the old 4-tuples against the records
+    path = show_path(0)
+    url = "http://127.0.0.1" + quote(path)
+    folder = solid.Folder(url, path)
+    tracemalloc.start()
+    files = []
+    for i in range(entries):
+        name = episode_name(0, i)
+        if records:
+            files.append(
+                solid.RemoteFile(folder, quote(name), name, 1700000000, "1000")
+            )
+        else:
+            files.append((url + quote(name), path + name, 1700000000, "1000"))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / 1024
+
+
+async def bench_db(args):
+    folder = tempfile.mkdtemp(prefix="emd-db-", dir=args.dir)
+    context = multiprocessing.get_context("spawn")
+    try:
+        print(f"Inserting {args.rows} rows, {args.per_folder} per folder")
+        print(
+            f"{'writer':>12} {'seconds':>10} {'rows/s':>12} {'DB MiB':>8} {'RSS MiB':>8}"
+        )
+        for name, insert in (
+            ("per-folder", insert_per_folder),
+            ("flat", insert_flat),
+            ("normalized", insert_batched),
+        ):
+            db = os.path.join(folder, f"{name}.db")
+            results, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_insert, args=(insert, db, args.rows, args.per_folder, sender)
+            )
+            process.start()
+            sender.close()
+            elapsed, rss = await asyncio.to_thread(results.recv)
+            process.join()
+            size = os.path.getsize(db) / 1048576
+            print(
+                f"{name:>12} {elapsed:>10.3f} {args.rows / elapsed:>12.0f} "
+                f"{size:>8.1f} {rss:>8.1f}"
+            )
+        print(
+            f"A listing of {args.entries} files holds "
+            f"{listing_kib(args.entries, False):.0f} KiB as tuples, "
+            f"{listing_kib(args.entries, True):.0f} KiB as records"
+        )
+    finally:
+        shutil.rmtree(folder)
+
+
+def mirror_tree(paths, depth, fanout, files, size, start=1700000000):
+    # Folder path -> autoindex entries, file path -> size, like a mirror's disk
+    folders = {}
+    blobs = {}
+
+    def fill(folder, level):
+        entries = []
+        for i in range(files):
+            name = f"episode {i}.nfo"
+            entries.append((name, False, start + i * 60, size))
+            blobs[folder + name] = size
+        if level < depth:
+            for i in range(fanout):
+                name = f"season {i}"
+                entries.append((name, True, start, 0))
+                fill(folder + name + "/", level + 1)
+        folders[folder] = entries
+
+    for path in paths:
+        fill("/" + unquote(path), 1)
+    folders["/"] = [(unquote(path).rstrip("/"), True, start, 0) for path in paths]
+    return folders, blobs
+
+
+def mirror_manifest(folders, blobs):
+    stamps = {}
+    for folder, entries in folders.items():
+        for name, is_dir, mtime, size in entries:
+            if not is_dir:
+                stamps[folder + name] = mtime
+    lines = (
+        f"{datetime.fromtimestamp(stamps[path]).strftime('%Y-%m-%d %H:%M')} {path}\n"
+        for path in blobs
+    )
+    return gzip.compress("".join(lines).encode("utf-8"))
+
+
+def serve_mirror(port, tree, latency, error_rate):
+    folders, blobs = mirror_tree(*tree)
+    manifest = mirror_manifest(folders, blobs)
+    pages = {}
+    for folder, entries in folders.items():
+        page = autoindex_page(folder, entries)
+        pages[folder] = (page, '"%x"' % zlib.crc32(page.encode("utf-8")))
+
+    async def handle(request):
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            return web.Response(status=503)
+        path = unquote(request.raw_path.split("?")[0])
+        if path == "/" + solid.MANIFEST:
+            return web.Response(body=manifest, content_type="application/gzip")
+        if path in pages:
+            page, etag = pages[path]
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+            return web.Response(
+                text=page, content_type="text/html", headers={"ETag": etag}
+            )
+        if path in blobs:
+            return web.Response(body=b"x" * blobs[path])
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_mirror(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+@contextlib.contextmanager
+def measured(name, rows, mirror):
+    # Only this process is measured, the mirror runs in its own
+    counts = {"files": 0}
+    requests = mirror.requests
+    downloaded = solid.metrics["downloaded"]
+    cpu = time.process_time()
+    start = time.perf_counter()
+    yield counts
+    elapsed = time.perf_counter() - start
+    rows.append(
+        (
+            name,
+            elapsed,
+            mirror.requests - requests,
+            counts["files"],
+            solid.metrics["downloaded"] - downloaded,
+            time.process_time() - cpu,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        )
+    )
+
+
+async def bench_mirror(args):
+    paths = solid.s_paths
+    tree = (paths, args.depth, args.fanout, args.files, args.size)
+    folders, blobs = mirror_tree(*tree)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/"
+    server = multiprocessing.get_context("spawn").Process(
+        target=serve_mirror,
+        args=(port, tree, args.latency, args.error_rate),
+        daemon=True,
+    )
+    server.start()
+    work = tempfile.mkdtemp(prefix="emd-mirror-", dir=args.dir)
+    try:
+        await wait_for_mirror(url)
+        print(
+            f"Mirror with {len(folders)} folders and {len(blobs)} files of {args.size} bytes, "
+            f"latency {args.latency * 1000:.1f}ms, {args.error_rate:.1%} errors"
+        )
+        media = os.path.join(work, "media")
+        for path in paths:
+            stale = os.path.join(media, unquote(path), "stale")
+            os.makedirs(stale)
+            for i in range(args.stale):
+                with open(os.path.join(stale, f"gone {i}.nfo"), "w") as f:
+                    f.write("x")
+        localdb = os.path.join(work, ".localfiles.db")
+        tempdb = os.path.join(work, ".tempfiles.db")
+        mirror = solid.Mirror(url, args.mirror_count)
+        mirrors = solid.MirrorPool([mirror])
+        rows = []
+
+        with measured("manifest", rows, mirror) as counts:
+            total = await solid.manifest_amount(mirrors, paths)
+            counts["files"] = total
+        with measured("local db", rows, mirror) as counts:
+            await solid.generate_localdb(
+                localdb, media, paths, full=True, workers=args.scan_workers
+            )
+            counts["files"] = len(paths) * args.stale
+
+        index_session = await aiosqlite.connect(localdb)
+        listing_cache = await aiosqlite.connect(os.path.join(work, ".listings.db"))
+        db_session = await aiosqlite.connect(tempdb)
+        await solid.create_listing_cache(listing_cache)
+        await solid.tune_db(db_session)
+        await solid.create_table(db_session)
+        parse_pool = None
+        if args.parse_workers:
+            parse_pool = solid.create_parse_pool(args.parse_workers)
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        ) as session:
+            for name, prune in (("cold crawl", False), ("warm crawl", True)):
+                with measured(name, rows, mirror) as counts:
+                    checked = solid.metrics["checked"]
+                    db_writer = solid.DBWriter(db_session)
+                    await solid.bulk_crawl_and_write(
+                        url=url,
+                        session=session,
+                        db_writer=db_writer,
+                        semaphore=asyncio.Semaphore(args.count),
+                        media=media,
+                        nfo=True,
+                        paths=paths,
+                        index_session=index_session,
+                        listing_cache=listing_cache,
+                        prune=prune,
+                        crawlers=args.crawlers,
+                        downloaders=args.downloaders,
+                        order="dfs",
+                        mirrors=mirrors,
+                        parse_pool=parse_pool,
+                    )
+                    # The crawl DB is complete once its writer is closed
+                    await db_writer.close()
+                    await solid.index_downloads(index_session, tempdb)
+                    await listing_cache.commit()
+                    counts["files"] = solid.metrics["checked"] - checked
+        if parse_pool:
+            parse_pool.shutdown()
+        await db_session.close()
+        await index_session.close()
+        await listing_cache.close()
+
+        with measured("purge", rows, mirror) as counts:
+            purged, parents = await solid.purge_removed_files(
+                localdb, tempdb, media, total, paths, workers=args.scan_workers
+            )
+            await asyncio.to_thread(solid.remove_empty_parents, parents, media, paths)
+            counts["files"] = purged
+
+        print(
+            f"{'phase':>12} {'seconds':>9} {'requests':>9} {'req/s':>9} {'files':>8} "
+            f"{'files/s':>9} {'fetched':>8} {'cpu s':>7} {'rss MiB':>8}"
+        )
+        for name, elapsed, requests, files, fetched, cpu, rss in rows:
+            print(
+                f"{name:>12} {elapsed:>9.3f} {requests:>9} {requests / elapsed:>9.0f} "
+                f"{files:>8} {files / elapsed:>9.0f} {fetched:>8} {cpu:>7.2f} {rss:>8.1f}"
+            )
+        if solid.metrics["download_failed"]:
+            print(f"{solid.metrics['download_failed']} downloads failed")
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(work)
+
+
+async def proxy_client(url, session, work, name, args):
+    # One instance on the LAN, with a media folder and crawl DB of its own
+    media = os.path.join(work, name)
+    conn = await aiosqlite.connect(os.path.join(work, name + ".db"))
+    await solid.tune_db(conn)
+    await solid.create_table(conn)
+    db_writer = solid.DBWriter(conn)
+    mirror = solid.Mirror(url, args.mirror_count)
+    await solid.bulk_crawl_and_write(
+        url=url,
+        session=session,
+        db_writer=db_writer,
+        semaphore=asyncio.Semaphore(args.count),
+        media=media,
+        nfo=True,
+        paths=solid.s_paths,
+        crawlers=args.crawlers,
+        downloaders=args.downloaders,
+        order="dfs",
+        mirrors=solid.MirrorPool([mirror]),
+    )
+    await db_writer.close()
+    await conn.close()
+    return mirror.requests
+
+
+def serve_proxy(port, url, folder, ttl, limit, control):
+    # A proxy host of its own, it reports its counters whenever the benchmark asks
+    async def serve():
+        upstream = solid.Mirror(url, limit)
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        ) as session:
+            runner, proxy = await solid.start_proxy(
+                port, session, solid.MirrorPool([upstream]), folder, ttl
+            )
+            while await asyncio.to_thread(control.recv):
+                control.send(
+                    (upstream.requests, proxy.hits, proxy.coalesced, proxy.revalidated)
+                )
+            await solid.stop_proxy(runner, proxy)
+
+    logging.getLogger("emd").setLevel(logging.ERROR)
+    asyncio.run(serve())
+
+
+async def bench_proxy(args):
+    tree = (solid.s_paths, args.depth, args.fanout, args.files, args.size)
+    folders, blobs = mirror_tree(*tree)
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/"
+    server = context.Process(
+        target=serve_mirror, args=(port, tree, args.latency, 0), daemon=True
+    )
+    server.start()
+    work = tempfile.mkdtemp(prefix="emd-proxy-", dir=args.dir)
+    proxy_port = free_port()
+    proxy_url = f"http://127.0.0.1:{proxy_port}/"
+    control, remote = context.Pipe()
+    proxy = context.Process(
+        target=serve_proxy,
+        args=(proxy_port, url, work, args.ttl, args.mirror_count, remote),
+        daemon=True,
+    )
+    proxy.start()
+
+    async def counters():
+        control.send(True)
+        return await asyncio.to_thread(control.recv)
+
+    try:
+        await wait_for_mirror(url)
+        await wait_for_mirror(proxy_url)
+        print(
+            f"{args.instances} instances syncing {len(folders)} folders and "
+            f"{len(blobs)} files, mirror latency {args.latency * 1000:.1f}ms"
+        )
+        print(
+            f"{'round':>8} {'seconds':>9} {'requests':>9} {'upstream':>9} "
+            f"{'hits':>7} {'coalesced':>10} {'revalidated':>12}"
+        )
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0)
+        ) as session:
+            for name, target in (
+                ("direct", url),
+                ("cold", proxy_url),
+                ("warm", proxy_url),
+            ):
+                before = await counters()
+                start = time.perf_counter()
+                requests = await asyncio.gather(
+                    *(
+                        proxy_client(target, session, work, f"{name}-{i}", args)
+                        for i in range(args.instances)
+                    )
+                )
+                elapsed = time.perf_counter() - start
+                after = await counters()
+                upstream, hits, coalesced, revalidated = (
+                    b - a for a, b in zip(before, after)
+                )
+                # Direct instances are the mirror's load without the proxy
+                if target == url:
+                    upstream = sum(requests)
+                print(
+                    f"{name:>8} {elapsed:>9.3f} {sum(requests):>9} {upstream:>9} "
+                    f"{hits:>7} {coalesced:>10} {revalidated:>12}"
+                )
+        if solid.metrics["download_failed"]:
+            print(f"{solid.metrics['download_failed']} downloads failed")
+    finally:
+        control.send(False)
+        proxy.join()
+        server.terminate()
+        server.join()
+        shutil.rmtree(work)
+
+
+def worker_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan = subparsers.add_parser("scan", help="Local DB scan throughput")
+    scan.add_argument("--dirs", type=int, default=500, help="Folders to generate")
+    scan.add_argument("--files", type=int, default=20, help="Files per folder")
+    scan.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Simulated seconds per readdir/stat, e.g. 0.001 for NFS",
+    )
+    scan.add_argument(
+        "--workers", type=worker_list, default=[1, 2, 4, 8, 16, 32]
+    )
+    scan.set_defaults(func=bench_scan)
+
+    parse = subparsers.add_parser("parse", help="Listing parser throughput")
+    parse.add_argument("--entries", type=int, default=20000, help="Listing size")
+    parse.add_argument("--rounds", type=int, default=5, help="Repetitions")
+    parse.set_defaults(func=bench_parse)
+
+    pool = subparsers.add_parser(
+        "pool", help="Listing parse throughput in the loop and in parser processes"
+    )
+    pool.add_argument("--listings", type=int, default=200, help="Listings to parse")
+    pool.add_argument("--entries", type=int, default=2000, help="Entries per listing")
+    pool.add_argument(
+        "--concurrency", type=int, default=20, help="Listings in flight, like --crawlers"
+    )
+    pool.add_argument(
+        "--workers",
+        type=worker_list,
+        default=[0, 1, 2, 4, 8],
+        help="Parser processes, 0 parses in the event loop",
+    )
+    pool.set_defaults(func=bench_pool)
+
+    db = subparsers.add_parser("db", help="Crawl DB insert throughput")
+    db.add_argument("--rows", type=int, default=1000000, help="Rows to insert")
+    db.add_argument(
+        "--per-folder", type=int, default=30, help="Rows per crawled folder"
+    )
+    db.add_argument(
+        "--dir", default=None, help="Where to put the DB files, e.g. the media disk"
+    )
+    db.add_argument(
+        "--entries", type=int, default=20000, help="Files in the measured listing"
+    )
+    db.set_defaults(func=bench_db)
+
+    mirror = subparsers.add_parser(
+        "mirror", help="End to end sync against a local mock mirror"
+    )
+    mirror.add_argument("--depth", type=int, default=4, help="Folder levels per path")
+    mirror.add_argument("--fanout", type=int, default=5, help="Subfolders per folder")
+    mirror.add_argument("--files", type=int, default=10, help="Files per folder")
+    mirror.add_argument("--size", type=int, default=2048, help="Bytes per file")
+    mirror.add_argument(
+        "--stale", type=int, default=100, help="Local files per path to purge"
+    )
+    mirror.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to every response"
+    )
+    mirror.add_argument(
+        "--error-rate", type=float, default=0, help="Share of requests answered 503"
+    )
+    mirror.add_argument("--count", type=int, default=100)
+    mirror.add_argument("--mirror-count", type=int, default=20)
+    mirror.add_argument("--crawlers", type=int, default=20)
+    mirror.add_argument("--downloaders", type=int, default=50)
+    mirror.add_argument("--scan-workers", type=int, default=8)
+    mirror.add_argument("--parse-workers", type=int, default=0)
+    mirror.add_argument("--dir", default=None, help="Where to put the media folder")
+    mirror.set_defaults(func=bench_mirror)
+
+    proxy = subparsers.add_parser(
+        "proxy", help="Instances syncing through the caching proxy"
+    )
+    proxy.add_argument("--instances", type=int, default=4, help="Instances on the LAN")
+    proxy.add_argument("--depth", type=int, default=3, help="Folder levels per path")
+    proxy.add_argument("--fanout", type=int, default=4, help="Subfolders per folder")
+    proxy.add_argument("--files", type=int, default=10, help="Files per folder")
+    proxy.add_argument("--size", type=int, default=2048, help="Bytes per file")
+    proxy.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to every response"
+    )
+    proxy.add_argument(
+        "--ttl", type=int, default=300, help="Seconds a cached listing is fresh"
+    )
+    proxy.add_argument("--count", type=int, default=100)
+    proxy.add_argument("--mirror-count", type=int, default=20)
+    proxy.add_argument("--crawlers", type=int, default=20)
+    proxy.add_argument("--downloaders", type=int, default=50)
+    proxy.add_argument("--dir", default=None, help="Where to put the media folders")
+    proxy.set_defaults(func=bench_proxy)
+
+    args = parser.parse_args()
+    # Errors include the injected 503s, failed downloads are counted in the report
+    logging.getLogger("emd").setLevel(
+        logging.CRITICAL if args.command == "mirror" else logging.ERROR
+    )
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -100,6 +100,14 @@ TWELVE_HOURS=$((12 * 60 * 60))
 if [ "$CYCLE" -lt "$TWELVE_HOURS" ]; then
     WARN "您设置的循环时间小于12h，对于服务器压力过大，同步下载将不会运行！"
     tail -f /dev/null
+elif [ "${DAEMON}" == "true" ]; then
+    # 常驻模式：进程内按 CYCLE 定时同步，保持连接和缓存，不再每次冷启动
+    if [ "${RESTART_AUTO_UPDATE}" == "true" ]; then
+        INFO "开始更新代码！"
+        update_app
+        INFO "更新成功！"
+    fi
+    main_solid --daemon --interval "${CYCLE}" --resume-max-age "$((CYCLE * 2))" $@
 else
     while true; do
         if [ "${RESTART_AUTO_UPDATE}" == "true" ]; then
@@ -107,7 +115,8 @@ else
             update_app
             INFO "更新成功！"
         fi
-        main_solid $@
+        # 中断的爬取在下次运行时续爬，检查点有效期须长于循环时间
+        main_solid --resume-max-age "$((CYCLE * 2))" $@
         INFO "等待${CYCLE}秒后下次运行！"
         sleep "${CYCLE}"
     done
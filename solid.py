@@ -3,20 +3,31 @@ import logging
 import sys, os
 import urllib.error
 import urllib.parse
-import urllib.request
 from urllib.parse import urljoin, urlparse, unquote, quote
 import aiohttp.client_exceptions
 from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import datetime, timezone
 import random
+import email.utils
 import re
-import gzip
+import zlib
+import collections
+import concurrent.futures
+import multiprocessing
+import time
+import signal
+import functools
+import contextlib
+import bisect
+import json
+import hashlib
+from html import unescape as html_unescape
 
 
 import asyncio
 import aiofiles
 import aiohttp
-from aiohttp import ClientSession, TCPConnector
+from aiohttp import ClientSession, TCPConnector, web
 import aiosqlite
 import aiofiles.os as aio_os
 
@@ -90,67 +101,640 @@ s_folder = [".sync"]
 
 s_ext = [".ass", ".srt", ".ssa"]
 
-# CF blocks urllib...
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+SCAN_BATCH_SIZE = 5000
+
+# Rows per crawl DB transaction, the writer task commits once per batch
+DB_BATCH_SIZE = 20000
+DB_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+"""
+# Both DBs keep each folder's path once and its files by folder id and name
+FILE_TABLES = """
+    CREATE TABLE IF NOT EXISTS dirs (
+        id INTEGER PRIMARY KEY,
+        parent INTEGER NULL,
+        path TEXT UNIQUE,
+        mtime INTEGER NULL);
+    CREATE TABLE IF NOT EXISTS files (
+        dir_id INTEGER,
+        name TEXT,
+        timestamp INTEGER NULL,
+        filesize INTEGER NULL,
+        PRIMARY KEY (dir_id, name)) WITHOUT ROWID;
+"""
+# Folder ids the crawl DB writer remembers, a crawl stores a folder's files together
+DIR_CACHE_SIZE = 4096
+# Seconds a crawl can lose when killed, the writer commits at least this often
+CHECKPOINT_SECONDS = 10
+# An unfinished crawl not saved for this long starts over, its listings are too stale
+# to trust, twice the default --interval so the next scheduled run still resumes it
+CHECKPOINT_MAX_AGE = 2 * 86400
+
+# Smaller listings parse faster in the loop than the round trip to a parser process takes
+PARSE_POOL_MIN_BYTES = 32 * 1024
+
+# Stale files handed from the DB diff to the purge step at a time
+PURGE_BATCH_SIZE = 1000
+
+# Sync interval of each tier as a multiple of --interval, hottest first
+TIER_FACTORS = {"hot": 0.25, "warm": 1, "cold": 7}
+# Tiers of the known paths until their change history says otherwise
+DEFAULT_TIERS = {
+    "每日更新/": "hot",
+    "纪录片（已刮削）/": "cold",
+    "ISO/": "cold",
+    "测试/": "cold",
+    "json/": "cold",
+    "📺画质演示测试（4K，8K，HDR，Dolby）/": "cold",
+}
+HISTORY_DAYS = 30
+# A daemon sync that failed or ended incomplete is tried again this soon, tier or not
+SYNC_RETRY_SECONDS = 600
+
+# Cloudflare answers these when it rate-limits
+THROTTLE_STATUSES = (429, 503, 510)
+LATENCY_CUT_FACTOR = 3
+LATENCY_CUT_FLOOR = 0.25
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+RETRY_AFTER_CAP = 300
+# How long a sharded crawl waits for slower mirrors to join the pool, shards copy it
+JOIN_WAIT_SECONDS = 3
+
+# Histogram bucket bounds in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+# nginx autoindex row: <a href="name">name</a>    03-Jun-2024 10:47    1234
+autoindex_entry = re.compile(
+    r'<a href="([^"]+)">([^<]*)</a>\s+(\d{2}-\w{3}-\d{4} \d{2}:\d{2})\s+(\S+)'
+)
+autoindex_months = {
+    month: number
+    for number, month in enumerate(
+        ["Jan", "Feb", "Mar", "Apr", "May", "Jun"]
+        + ["Jul", "Aug", "Sep", "Oct", "Nov", "Dec"],
+        start=1,
+    )
+}
+
+# CF blocks the default user agent of HTTP libraries when fetching the file list
 
 CUSTOM_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36"
-opener = urllib.request.build_opener()
-opener.addheaders = [("User-Agent", CUSTOM_USER_AGENT)]
-urllib.request.install_opener(opener)
+
+MANIFEST = ".scan.list.gz"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        # Upper bound of the bucket the quantile falls in, never above the max seen
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, round(self.max, 4))
+        return round(self.max, 4)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "mean": round(self.sum / self.count, 4) if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 4),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.changes = collections.Counter()
+        self.phases = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.first_download = None
+
+    def reset(self):
+        self.counters.clear()
+        self.changes.clear()
+        self.phases.clear()
+        self.histograms.clear()
+        self.started = time.time()
+        self.first_download = None
+
+    def __getitem__(self, name):
+        return self.counters[name]
+
+    def merge(self, counters, changes, histograms, first_download=None):
+        # Adds up what a shard process counted
+        self.counters.update(counters)
+        self.changes.update(changes)
+        if first_download:
+            self.download_finished(first_download)
+        for key, histogram in histograms.items():
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(histogram.buckets)
+            self.histograms[key].merge(histogram)
+
+    def __setitem__(self, name, value):
+        self.counters[name] = value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def download_finished(self, at=None):
+        # How long the startup kept the first file waiting
+        at = at or time.time()
+        if self.first_download is None or at < self.first_download:
+            self.first_download = at
+
+    def time_to_first_download(self):
+        if self.first_download is None:
+            return None
+        return max(0.0, self.first_download - self.started)
+
+    def observe(self, name, label, value, buckets=LATENCY_BUCKETS):
+        key = (name, label)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def summary(self):
+        histograms = {}
+        for (name, label), histogram in self.histograms.items():
+            histograms.setdefault(name, {})[label or "all"] = histogram.summary()
+        counters = dict(self.counters)
+        wall = time.time() - self.started
+        return {
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "wall_seconds": round(wall, 3),
+            "first_download_seconds": round(self.time_to_first_download(), 3)
+            if self.first_download
+            else None,
+            "phases": {name: round(value, 3) for name, value in self.phases.items()},
+            "counters": counters,
+            "rates": {
+                "files_per_second": round(counters.get("downloaded", 0) / wall, 2),
+                "bytes_per_second": round(
+                    counters.get("bytes_downloaded", 0) / wall, 1
+                ),
+                "db_rows_per_second": round(
+                    counters.get("db_rows", 0) / counters["db_seconds"], 1
+                )
+                if counters.get("db_seconds")
+                else 0,
+            },
+            "histograms": histograms,
+        }
+
+    def prometheus(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE emd_{name} gauge")
+            lines.append(f"emd_{name} {value}")
+        if self.first_download:
+            lines.append("# TYPE emd_first_download_seconds gauge")
+            lines.append(
+                f"emd_first_download_seconds {self.time_to_first_download():.3f}"
+            )
+        lines.append("# TYPE emd_phase_seconds gauge")
+        for name, value in self.phases.items():
+            lines.append(f'emd_phase_seconds{{phase="{name}"}} {value:.3f}')
+        typed = set()
+        for (name, label), histogram in self.histograms.items():
+            if name not in typed:
+                lines.append(f"# TYPE emd_{name} histogram")
+                typed.add(name)
+            labels = f'mirror="{label}",' if label else ""
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'emd_{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'emd_{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+            labels = "{" + labels.rstrip(",") + "}" if labels else ""
+            lines.append(f"emd_{name}_sum{labels} {histogram.sum:.6f}")
+            lines.append(f"emd_{name}_count{labels} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+async def watch_loop_lag(interval=0.25):
+    # Oversleeping means a callback hogged the event loop
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        metrics.observe("loop_lag_seconds", None, lag, LOOP_LAG_BUCKETS)
 
 
-def pick_a_pool_member(url_list):
-    random.shuffle(url_list)
-    for member in url_list:
+async def start_metrics_server(port):
+    async def handle(request):
+        return web.Response(
+            text=metrics.prometheus(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info("Serving metrics on port %d", port)
+    return runner
+
+
+def write_metrics(path):
+    temp_path = path + ".part"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(metrics.summary(), f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+class AdaptiveLimiter:
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(minimum, maximum // 4))
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.paused_until = 0.0
+        self.last_cut = 0.0
+        self.base_latency = None
+        self.cuts = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
         try:
-            logger.debug("Testing: %s", member)
-            response = urllib.request.urlopen(member)
-            if response.getcode() == 200:
-                content = response.read()
-                try:
-                    content_decoded = content.decode("utf-8")
-                    if "每日更新" in content_decoded:
-                        logger.info("Picked: %s", member)
-                        return member
-                    else:
-                        logger.info("Content at %s does not contain '每日更新'", member)
-                except UnicodeDecodeError:
-                    logger.info("Non-UTF-8 content at %s", member)
-        except Exception as e:
-            logger.info("Error accessing %s: %s", member, e)
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify(max(1, int(self.limit) - self.in_flight))
+
+    def success(self, latency):
+        # The lowest time to first byte seen so far, allowed to drift up slowly
+        if self.base_latency is None:
+            self.base_latency = latency
+        else:
+            self.base_latency = min(latency, self.base_latency * 1.001)
+        if latency > max(
+            LATENCY_CUT_FACTOR * self.base_latency,
+            self.base_latency + LATENCY_CUT_FLOOR,
+        ):
+            self.cut()
+            return
+        # Additive increase: about one more slot per window of healthy responses
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def cut(self):
+        now = time.monotonic()
+        # Everything in flight reports the same congestion, back off once per second
+        if now - self.last_cut < 1:
+            return
+        self.last_cut = now
+        self.cuts += 1
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def parse_retry_after(headers):
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (
+                email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)
+            ).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), RETRY_AFTER_CAP)
+
+
+def retry_delay(attempt):
+    # Full jitter, so a burst of failures doesn't come back as a burst of retries
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def retryable(status):
+    # Client errors other than timeouts and rate limits won't change on a retry
+    return status is None or status >= 500 or status in (408, 429)
+
+
+def unanimous(answers):
+    # The status every mirror that was reached gave, None while one was down or they
+    # disagree: a lagging mirror's 404 says nothing while the others time out
+    statuses = set(answers.values())
+    if len(statuses) == 1:
+        return statuses.pop()
+    return None
+
+
+class Mirror:
+    def __init__(self, url, limit, latency=1.0):
+        self.url = url.rstrip("/") + "/"
+        self.limiter = AdaptiveLimiter(limit)
+        self.latency = latency
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.failures = 0
+        self.demotions = 0
+        self.demoted_until = 0.0
+
+    def healthy(self):
+        now = time.monotonic()
+        return self.demoted_until <= now and self.limiter.paused_until <= now
+
+    def score(self):
+        # Fast mirrors win until their queue makes a slower idle one the better bet
+        return self.latency * (1 + self.in_flight)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.limiter.slot():
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+
+    def record(self, elapsed, size=0, first_byte=None):
+        self.requests += 1
+        self.bytes += size
+        self.busy += elapsed
+        self.latency = 0.8 * self.latency + 0.2 * elapsed
+        self.failures = 0
+        response_time = elapsed if first_byte is None else first_byte
+        self.limiter.success(response_time)
+        metrics.observe("response_seconds", self.url, response_time)
+
+    def fail(self, status=None, retry_after=None):
+        self.requests += 1
+        self.errors += 1
+        if status is None or status in THROTTLE_STATUSES:
+            self.limiter.cut()
+        if retry_after:
+            self.limiter.pause(retry_after)
+        # Missing files are the URL's fault, overload and outages are the mirror's
+        if status is not None and status < 500 and status != 429:
+            return
+        if not self.healthy():
+            # Requests issued before the demotion are still failing
+            return
+        self.failures += 1
+        if self.failures >= 3:
+            self.demotions += 1
+            duration = min(30 * 2 ** (self.demotions - 1), 600)
+            self.demoted_until = time.monotonic() + duration
+            self.failures = 0
+            logger.warning(
+                "Mirror %s demoted for %ds after repeated failures", self.url, duration
+            )
+
+
+class MirrorPool:
+    def __init__(self, mirrors):
+        self.mirrors = mirrors
+        # Crawl URLs are built on the first mirror and rewritten per request
+        self.base = mirrors[0].url
+        # Probes of the mirrors that had not answered when the pool was picked
+        self.joining = None
+
+    def pick(self, exclude=()):
+        candidates = [m for m in self.mirrors if m not in exclude] or self.mirrors
+        healthy = [m for m in candidates if m.healthy()] or candidates
+        return min(healthy, key=Mirror.score)
+
+    def has_alternative(self, tried):
+        return any(m not in tried for m in self.mirrors)
+
+    def resolve(self, url, mirror):
+        if url.startswith(self.base):
+            return mirror.url + url[len(self.base) :]
+        return url
+
+    def report(self):
+        for m in self.mirrors:
+            logger.info(
+                "Mirror %s: %d requests, %d errors, %.1f MiB, %.0f ms latency, %.1f KiB/s, concurrency %d after %d cuts",
+                m.url,
+                m.requests,
+                m.errors,
+                m.bytes / 1048576,
+                m.latency * 1000,
+                m.bytes / 1024 / m.busy if m.busy else 0,
+                int(m.limiter.limit),
+                m.limiter.cuts,
+            )
+
+
+async def probe_mirror(session, url):
+    start = time.perf_counter()
+    try:
+        logger.debug("Testing: %s", url)
+        async with session.get(url) as response:
+            if response.status != 200:
+                logger.info("Error accessing %s: %s", url, response.status)
+                return None
+            content = await response.read()
+        latency = time.perf_counter() - start
+        if "每日更新" in content.decode("utf-8"):
+            return latency
+        logger.info("Content at %s does not contain '每日更新'", url)
+    except UnicodeDecodeError:
+        logger.info("Non-UTF-8 content at %s", url)
+    except Exception as e:
+        logger.info("Error accessing %s: %s", url, e)
     return None
 
 
-def current_amount(url, media, paths):
-    listfile = os.path.join(media, ".scan.list.gz")
+async def pick_pool_members(url_list, limit):
+    session = ClientSession(
+        connector=TCPConnector(ssl=False),
+        timeout=aiohttp.ClientTimeout(total=15),
+    )
+    probes = {
+        asyncio.create_task(probe_mirror(session, url)): url for url in url_list
+    }
+    pending = set(probes)
+    mirrors = []
+    # The sync starts on the first mirror that answers, slower ones join it later
+    while pending and not mirrors:
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED
+        )
+        mirrors = [
+            Mirror(probes[probe], limit, probe.result())
+            for probe in done
+            if probe.result() is not None
+        ]
+    if not mirrors:
+        await session.close()
+        return None
+    mirrors.sort(key=lambda m: m.latency)
+    for m in mirrors:
+        logger.info("Picked: %s [%.0f ms]", m.url, m.latency * 1000)
+    pool = MirrorPool(mirrors)
+    pool.joining = asyncio.create_task(
+        join_pool(pool, session, probes, pending, limit)
+    )
+    return pool
+
+
+async def join_pool(pool, session, probes, pending, limit):
     try:
-        res = urllib.request.urlretrieve(url, listfile)
-        with gzip.open(listfile) as response:
-            pattern = r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2} \/(.*)$"
-            hidden_pattern = r"^.*?\/\..*$"
-            matching_lines = 0
-            for line in response:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for probe in done:
+                if probe.result() is None:
+                    continue
+                mirror = Mirror(probes[probe], limit, probe.result())
+                pool.mirrors.append(mirror)
+                logger.info(
+                    "Picked: %s [%.0f ms]", mirror.url, mirror.latency * 1000
+                )
+    finally:
+        for probe in pending:
+            probe.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await session.close()
+
+
+def manifest_selector(paths):
+    # One compiled alternation instead of unquoting every selected path per line
+    return re.compile("|".join(re.escape(unquote(path)) for path in paths))
+
+
+@functools.lru_cache(maxsize=4096)
+def manifest_timestamp(value):
+    return int(datetime.strptime(value, "%Y-%m-%d %H:%M").timestamp())
+
+
+def parse_manifest_line(line, selector):
+    # 2024-06-03 10:47 /电影/Movie (2024)/Movie (2024).nfo
+    line = line.decode(encoding="utf-8").strip()
+    if line[16:18] != " /":
+        return None
+    file = line[18:]
+    if not selector.match(file) or "/." in file or file.lower().endswith(".txt"):
+        return None
+    return "/" + file, manifest_timestamp(line[:16])
+
+
+async def stream_manifest(session, url, paths):
+    selector = manifest_selector(paths)
+    decompressor = None
+    pending = b""
+    async with session.get(
+        url, headers={"User-Agent": CUSTOM_USER_AGENT}
+    ) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            if decompressor is None:
+                # Some servers already strip the gzip layer with Content-Encoding
+                decompressor = (
+                    zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if chunk.startswith(b"\x1f\x8b")
+                    else False
+                )
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
                 try:
-                    line = line.decode(encoding="utf-8").strip()
-                    match = re.match(pattern, line)
-                    if match:
-                        file = match.group(1)
-                        if any(file.startswith(unquote(path)) for path in paths):
-                            if not re.match(
-                                hidden_pattern, file
-                            ) and not file.lower().endswith(".txt"):
-                                matching_lines += 1
-                except:
+                    entry = parse_manifest_line(line, selector)
+                except ValueError:
                     logger.error("Error decoding line: %s", line)
-        return matching_lines
-    except urllib.error.URLError as e:
-        print("Error:", e)
-        return -1
+                    continue
+                if entry:
+                    yield entry
+    if decompressor:
+        pending += decompressor.flush()
+    try:
+        entry = parse_manifest_line(pending, selector)
+    except ValueError:
+        logger.error("Error decoding line: %s", pending)
+        entry = None
+    if entry:
+        yield entry
+
+
+async def manifest_amount(mirrors, paths):
+    with metrics.phase("manifest"):
+        return await count_manifest(mirrors, paths)
+
+
+async def count_manifest(mirrors, paths):
+    async with ClientSession(
+        connector=TCPConnector(ssl=False),
+        timeout=aiohttp.ClientTimeout(total=600),
+    ) as session:
+        for mirror in mirrors.mirrors:
+            try:
+                amount = 0
+                async for _ in stream_manifest(session, mirror.url + MANIFEST, paths):
+                    amount += 1
+                logger.info("There are %d files in %s", amount, mirror.url)
+                return amount
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+                logger.error("Unable to read the file list from %s: %s", mirror.url, e)
+    return -1
 
 
-async def fetch_html(url, session, **kwargs) -> str:
+async def fetch_html(url, session, mirror, headers=None, **kwargs) -> tuple:
     semaphore = kwargs["semaphore"]
-    async with semaphore:
-        async with session.request(method="GET", url=url) as resp:
+    async with mirror.slot(), semaphore:
+        start = time.perf_counter()
+        async with session.request(method="GET", url=url, headers=headers) as resp:
+            first_byte = time.perf_counter() - start
             logger.debug(
                 "Request Headers for [%s]: [%s]",
                 unquote(url),
@@ -159,60 +743,408 @@ async def fetch_html(url, session, **kwargs) -> str:
             resp.raise_for_status()
             logger.debug("Response Headers for [%s]: [%s]", unquote(url), resp.headers)
             logger.debug("Got response [%s] for URL: %s", resp.status, unquote(url))
+            if resp.status == 304:
+                mirror.record(time.perf_counter() - start, first_byte=first_byte)
+                return resp.status, None, resp.headers
             try:
                 text = await resp.text()
-                return text
+                mirror.record(time.perf_counter() - start, len(text), first_byte)
+                return resp.status, text, resp.headers
             except UnicodeDecodeError:
                 logger.error("Non-UTF-8 content at %s", unquote(url))
-                return None
+                return resp.status, None, resp.headers
 
 
-async def parse(url, session, max_retries=3, **kwargs) -> set:
+async def parse(url, session, max_retries=3, mtime=None, **kwargs) -> tuple:
+    # None when the folder could not be listed, which is not the same as empty
     global html
     retries = 0
-    files = []
-    directories = []
+    # Last status per mirror, None for one that could not be reached
+    answers = {}
+    listing_cache = kwargs.get("listing_cache")
+    cached = None
+    if listing_cache:
+        cached = await cached_listing(listing_cache, url)
+        # The parent lists this folder with the same mtime as last time, so nothing
+        # was added, removed or renamed in it: replay the cached listing offline
+        if cached and kwargs.get("prune") and mtime is not None and cached[2] == mtime:
+            metrics["listing_pruned"] += 1
+            files, directories = cached[1]
+            # Its subfolders' mtimes are as old as the cache, a change further down
+            # only shows in them, so they are revalidated instead of pruned in turn
+            return files, [(link, None) for link, _ in directories]
+    mirrors = kwargs["mirrors"]
+    tried = set()
     while True:
         if retries < max_retries:
+            mirror = mirrors.pick(exclude=tried)
             try:
-                html = await fetch_html(url=url, session=session, **kwargs)
+                status, html, headers = await fetch_html(
+                    url=mirrors.resolve(url, mirror),
+                    session=session,
+                    mirror=mirror,
+                    headers=cached[0] if cached else None,
+                    **kwargs,
+                )
+                if status == 304 and cached:
+                    metrics["listing_not_modified"] += 1
+                    if mtime is not None and cached[2] != mtime:
+                        await touch_listing(
+                            listing_cache, url, mtime, kwargs.get("listing_writer")
+                        )
+                    return cached[1]
                 if html is None:
                     logger.debug(
                         "Failed to fetch HTML content for URL: %s", unquote(url)
                     )
-                    return files, directories
+                    return None
                 break
             except aiohttp.ClientResponseError as e:
                 logger.error(
                     "aiohttp ClientResponseError for %s [%s]: %s. Retrying (%d/%d)...",
-                    unquote(url),
+                    unquote(mirrors.resolve(url, mirror)),
                     getattr(e, "status", None),
                     getattr(e, "message", None),
                     retries + 1,
                     max_retries,
                 )
+                mirror.fail(e.status, parse_retry_after(e.headers))
+                tried.add(mirror)
+                answers[mirror] = e.status
+                if not retryable(e.status) and not mirrors.has_alternative(tried):
+                    # A folder no mirror has is gone, not unlisted
+                    return ([], []) if unanimous(answers) == 404 else None
                 retries += 1
+                if retries < max_retries:
+                    await asyncio.sleep(retry_delay(retries))
             except (
                 aiohttp.ClientError,
                 aiohttp.http_exceptions.HttpProcessingError,
                 aiohttp.ClientPayloadError,
+                asyncio.TimeoutError,
             ) as e:
                 logger.error(
-                    "aiohttp exception for %s [%s]: %s",
-                    unquote(url),
+                    "aiohttp exception for %s [%s]: %s. Retrying (%d/%d)...",
+                    unquote(mirrors.resolve(url, mirror)),
                     getattr(e, "status", None),
                     getattr(e, "message", None),
+                    retries + 1,
+                    max_retries,
                 )
-                return files, directories
+                mirror.fail()
+                tried.add(mirror)
+                answers[mirror] = None
+                retries += 1
+                if retries < max_retries:
+                    await asyncio.sleep(retry_delay(retries))
             except Exception as e:
                 logger.exception(
                     "Non-aiohttp exception occurred:  %s", getattr(e, "__dict__", {})
                 )
-                return files, directories
+                return None
         else:
             logger.error("Max retries reached for %s. Request failed.", unquote(url))
-            return files, directories
+            return ([], []) if unanimous(answers) == 404 else None
+
+    if kwargs.get("parse_pool") and len(html) >= PARSE_POOL_MIN_BYTES:
+        listing = await parse_listing_in_pool(url, html, kwargs["parse_pool"])
+    else:
+        listing = parse_listing(url, html)
+    if listing_cache:
+        metrics["listing_changed" if cached else "listing_new"] += 1
+        await store_listing(
+            listing_cache, url, headers, listing, mtime, kwargs.get("listing_writer")
+        )
+    return listing
+
+
+async def create_listing_cache(conn):
+    try:
+        await conn.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                path TEXT PRIMARY KEY,
+                etag TEXT NULL,
+                last_modified TEXT NULL,
+                mtime INTEGER NULL,
+                listing TEXT);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value);
+        """)
+        await conn.commit()
+    except Exception as e:
+        logger.error("Unable to create DB due to %s", e)
+        sys.exit(1)
+
+
+def url_origin(url):
+    parts = urlparse(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+async def cached_listing(conn, url):
+    # Keyed by path with links stored relative to the server, so any mirror can reuse it
+    async with conn.execute(
+        "SELECT etag, last_modified, mtime, listing FROM listings WHERE path = ?",
+        (urlparse(url).path,),
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    etag, last_modified, mtime, listing = row
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    origin = url_origin(url)
+    files, directories = json.loads(listing)
+    folder = Folder(url, unquote(urlparse(url).path))
+    # The folder's own files by link and name, anything else by full link and path
+    files = [
+        RemoteFile(folder, link, name, timestamp, filesize)
+        if not link.startswith("/")
+        else RemoteFile.at(origin + link, name, timestamp, filesize, folder)
+        for link, name, timestamp, filesize in files
+    ]
+    directories = [(origin + link, timestamp) for link, timestamp in directories]
+    return headers, (files, directories), mtime
+
+
+async def store_listing(conn, url, headers, listing, mtime=None, writer=None):
+    files, directories = listing
+    offset = len(url_origin(url))
+    listing = json.dumps(
+        [
+            [
+                (file.href, file.name, file.timestamp, file.filesize)
+                if file.folder.url == url
+                else (file.url[offset:], file.filename, file.timestamp, file.filesize)
+                for file in files
+            ],
+            [(link[offset:], timestamp) for link, timestamp in directories],
+        ],
+        ensure_ascii=False,
+    )
+    row = (
+        urlparse(url).path,
+        headers.get("ETag"),
+        headers.get("Last-Modified"),
+        mtime,
+        listing,
+    )
+    statement = "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)"
+    if writer:
+        # A shard keeps its updates in its crawl DB, the coordinator merges them
+        await writer.put([row], statement)
+    else:
+        await conn.execute(statement, row)
+
+
+async def touch_listing(conn, url, mtime, writer=None):
+    if writer:
+        await writer.put(
+            [(urlparse(url).path, mtime)],
+            "INSERT OR REPLACE INTO listing_mtimes VALUES (?, ?)",
+        )
+    else:
+        await conn.execute(
+            "UPDATE listings SET mtime = ? WHERE path = ?", (mtime, urlparse(url).path)
+        )
+
+
+async def last_full_crawl(conn, paths):
+    # Tracked per path, a daemon crawls them on different schedules
+    keys = ["full_crawl:" + unquote(path) for path in paths]
+    async with conn.execute(
+        f"SELECT key, value FROM state WHERE key IN ({', '.join('?' * len(keys))})",
+        keys,
+    ) as cursor:
+        done = dict(await cursor.fetchall())
+    return min(done.get(key, 0) for key in keys)
+
+
+async def mark_full_crawl(conn, paths):
+    await conn.executemany(
+        "INSERT OR REPLACE INTO state VALUES (?, ?)",
+        [("full_crawl:" + unquote(path), int(time.time())) for path in paths],
+    )
+
+
+async def last_synced(conn, path):
+    async with conn.execute(
+        "SELECT value FROM state WHERE key = ?", ("synced:" + unquote(path),)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def change_history(conn, path):
+    async with conn.execute(
+        "SELECT value FROM state WHERE key = ?", ("changes:" + unquote(path),)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return json.loads(row[0]) if row else []
+
+
+async def record_sync(conn, paths, changes):
+    now = int(time.time())
+    for path in paths:
+        history = [
+            entry
+            for entry in await change_history(conn, path)
+            if entry[0] > now - HISTORY_DAYS * 86400
+        ]
+        history.append([now, changes[path]])
+        await conn.executemany(
+            "INSERT OR REPLACE INTO state VALUES (?, ?)",
+            [
+                ("changes:" + unquote(path), json.dumps(history)),
+                ("synced:" + unquote(path), now),
+            ],
+        )
+
+
+def parse_listing(url, html):
+    listing = parse_autoindex(url, html)
+    if listing is None:
+        logger.debug("Unexpected listing markup at %s", unquote(url))
+        metrics["soup_parses"] += 1
+        listing = parse_soup(url, html)
+    return listing
+
+
+def parse_listing_worker(url, html):
+    # Runs in a parser process, whose logs and metrics never reach the run
+    listing = parse_autoindex(url, html)
+    if listing is None:
+        return parse_soup(url, html), True
+    return listing, False
+
+
+async def parse_listing_in_pool(url, html, pool):
+    listing, soup = await asyncio.get_running_loop().run_in_executor(
+        pool, parse_listing_worker, url, html
+    )
+    if soup:
+        logger.debug("Unexpected listing markup at %s", unquote(url))
+        metrics["soup_parses"] += 1
+    return listing
+
+
+def create_parse_pool(workers):
+    # Spawned, forking a process that already runs aiosqlite threads can deadlock
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@functools.lru_cache(maxsize=65536)
+def listing_timestamp(value):
+    # "03-Jun-2024 10:47", nginx always writes English month names
+    timestamp = datetime(
+        int(value[7:11]),
+        autoindex_months[value[3:6]],
+        int(value[0:2]),
+        int(value[12:14]),
+        int(value[15:17]),
+    )
+    return int(timestamp.timestamp())
+
+
+class Folder:
+    # Shared by the files listed in it, so its URL and path are held once
+    __slots__ = ("url", "path")
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+
+    @property
+    def dirname(self):
+        return self.path.rstrip("/") or "/"
+
+
+class RemoteFile:
+    # A listed file as its folder plus its own link and name, instead of two full paths
+    __slots__ = ("folder", "href", "name", "timestamp", "filesize")
+
+    def __init__(self, folder, href, name, timestamp, filesize):
+        self.folder = folder
+        self.href = href
+        self.name = name
+        self.timestamp = timestamp
+        self.filesize = filesize
+
+    @classmethod
+    def at(cls, url, filename, timestamp, filesize, folder=None):
+        # Reuses folder when the file is in it, e.g. the previous file's
+        cut = url.rfind("/") + 1
+        if folder is None or folder.url != url[:cut]:
+            folder = Folder(url[:cut], filename[: filename.rfind("/") + 1])
+        return cls(
+            folder, url[cut:], filename[len(folder.path) :], timestamp, filesize
+        )
+
+    @property
+    def url(self):
+        return self.folder.url + self.href
+
+    @property
+    def filename(self):
+        return self.folder.path + self.name
+
+
+def parse_autoindex(url, html):
+    if "<pre>" not in html:
+        return None
+    files = []
+    directories = []
+    folder = Folder(url, unquote(urlparse(url).path))
+    matched = 0
+    for match in autoindex_entry.finditer(html):
+        matched += 1
+        href, label, timestamp_str, filesize = match.groups()
+        if "&" in href:
+            href = html_unescape(href)
+        if href == "../" or "/cdn-cgi/l/email-protection" in href:
+            continue
+        # Plain relative names resolve by concatenation, anything else goes through urljoin
+        plain = url.endswith("/") and "/" not in href.rstrip("/") and ":" not in href
+        if plain:
+            abslink = url + href
+            if label.endswith("..>") or "&" in label:
+                # Truncated or escaped label, decode the link instead
+                label = unquote(href)
+        else:
+            abslink = urljoin(url, href)
+        if not href.endswith("/") and not href.endswith("txt") and href != "scan.list":
+            try:
+                timestamp = listing_timestamp(timestamp_str)
+            except (KeyError, ValueError):
+                logger.exception("Error parsing URL: %s", unquote(abslink))
+                continue
+            if plain:
+                file = RemoteFile(folder, href, label, timestamp, filesize)
+            else:
+                filename = unquote(urlparse(abslink).path)
+                file = RemoteFile.at(abslink, filename, timestamp, filesize, folder)
+            files.append(file)
+        elif href.endswith("/") and not href.lower().endswith(".txt"):
+            try:
+                directories.append((abslink, listing_timestamp(timestamp_str)))
+            except (KeyError, ValueError):
+                directories.append((abslink, None))
+    if not matched and html.count("<a ") > 1:
+        # Links but no autoindex rows, let BeautifulSoup make sense of it
+        return None
+    return files, directories
 
+
+def parse_soup(url, html):
+    files = []
+    directories = []
+    folder = Folder(url, unquote(urlparse(url).path))
     soup = BeautifulSoup(html, "html.parser")
     for link in soup.find_all("a"):
         href = link.get("href")
@@ -228,11 +1160,12 @@ async def parse(url, session, max_retries=3, **kwargs) -> set:
             try:
                 abslink = urljoin(url, href)
                 filename = unquote(urlparse(abslink).path)
-                timestamp_str = link.next_sibling.strip().split()[0:2]
-                timestamp = datetime.strptime(" ".join(timestamp_str), "%d-%b-%Y %H:%M")
-                timestamp_unix = int(timestamp.timestamp())
-                filesize = link.next_sibling.strip().split()[2]
-                files.append((abslink, filename, timestamp_unix, filesize))
+                columns = link.next_sibling.strip().split()
+                timestamp_unix = listing_timestamp(" ".join(columns[0:2]))
+                filesize = columns[2]
+                files.append(
+                    RemoteFile.at(abslink, filename, timestamp_unix, filesize, folder)
+                )
             except (urllib.error.URLError, ValueError):
                 logger.exception("Error parsing URL: %s", unquote(link))
                 continue
@@ -240,21 +1173,27 @@ async def parse(url, session, max_retries=3, **kwargs) -> set:
                 logger.exception("Unexpected error: %s", e)
                 continue
         elif href != "../" and not href.lower().endswith(".txt"):
-            directories.append(urljoin(url, href))
+            try:
+                columns = link.next_sibling.strip().split()
+                timestamp_unix = listing_timestamp(" ".join(columns[0:2]))
+            except Exception:
+                timestamp_unix = None
+            directories.append((urljoin(url, href), timestamp_unix))
     return files, directories
 
 
-async def need_download(file, **kwargs):
-    url, filename, timestamp, filesize = file
-    file_path = os.path.join(kwargs["media"], filename.lstrip("/"))
-    if not os.path.exists(file_path):
-        logger.debug("%s doesn't exists", file_path)
+def need_download(file, current, nfo):
+    filename, timestamp, filesize = file.filename, file.timestamp, file.filesize
+    if current is None:
+        logger.debug("%s doesn't exists", filename)
         return True
-    elif file_path.endswith(".nfo"):
-        if not kwargs["nfo"]:
+    elif filename.endswith(".nfo"):
+        if not nfo:
             return False
-    current_filesize = os.path.getsize(file_path)
-    current_timestamp = os.path.getmtime(file_path)
+    current_filesize, current_timestamp = current
+    if filesize is None:
+        # Manifest entries carry no size, the timestamp alone decides
+        return int(timestamp) > int(current_timestamp)
     logger.debug("%s has timestamp: %s and size: %s", filename, timestamp, filesize)
     if int(filesize) == int(current_filesize) and int(timestamp) <= int(
         current_timestamp
@@ -269,61 +1208,525 @@ async def need_download(file, **kwargs):
     return True
 
 
-async def download(file, session, **kwargs):
-    url, filename, timestamp, filesize = file
+def stat_local_files(folder, names):
+    current = {}
+    calls = 1
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name in names and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                        calls += 1
+                        current[entry.name] = (stat.st_size, int(stat.st_mtime))
+                    except OSError:
+                        continue
+    except FileNotFoundError:
+        pass
+    return current, calls
+
+
+async def local_files(dirname, names, **kwargs):
+    current = {}
+    index_session = kwargs.get("index_session")
+    ready = kwargs.get("index_ready")
+    # A half built index misses what is on disk, until it is whole the disk tells
+    if index_session and (ready is None or ready.is_set()):
+        async with index_session.execute(
+            """
+            SELECT name, timestamp, filesize FROM files
+            WHERE dir_id = (SELECT id FROM dirs WHERE path = ?)
+        """,
+            (dirname,),
+        ) as cursor:
+            for name, timestamp, filesize in await cursor.fetchall():
+                current[name] = (filesize, timestamp)
+        metrics["index_lookups"] += 1
+        # The index skips hidden files and subtitles, those still need a look on disk
+        names = set(
+            name
+            for name in names
+            if name not in current
+            and (name.startswith(".") or name.lower().endswith(tuple(s_ext)))
+        )
+        if not names:
+            return current
+    found, calls = await asyncio.to_thread(
+        stat_local_files, kwargs["media"] + dirname, names
+    )
+    metrics["syscalls"] += calls
+    current.update(found)
+    return current
+
+
+async def download(file, session, max_retries=3, **kwargs):
+    url, filename = file.url, file.filename
     semaphore = kwargs["semaphore"]
-    async with semaphore:
+    mirrors = kwargs["mirrors"]
+    tried = set()
+    for attempt in range(1, max_retries + 1):
+        mirror = mirrors.pick(exclude=tried)
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    file_path = os.path.join(kwargs["media"], filename.lstrip("/"))
-                    os.umask(0)
-                    os.makedirs(os.path.dirname(file_path), mode=0o777, exist_ok=True)
-                    async with aiofiles.open(file_path, "wb") as f:
-                        logger.debug("Starting to write file: %s", filename)
-                        await f.write(await response.content.read())
-                        logger.debug("Finish to write file: %s", filename)
-                    os.chmod(file_path, 0o777)
-                    logger.info("Downloaded: %s", filename)
-                else:
+            async with mirror.slot(), semaphore:
+                start = time.perf_counter()
+                async with session.get(mirrors.resolve(url, mirror)) as response:
+                    first_byte = time.perf_counter() - start
+                    if response.status == 200:
+                        written = await save_response(response, file, **kwargs)
+                        mirror.record(
+                            time.perf_counter() - start, written or 0, first_byte
+                        )
+                        if written is None:
+                            break
+                        logger.info("Downloaded: %s", filename)
+                        metrics.download_finished()
+                        metrics["downloaded"] += 1
+                        metrics["bytes_downloaded"] += written
+                        metrics.changes[owning_path(filename, kwargs["paths"])] += 1
+                        if kwargs.get("db_writer"):
+                            await kwargs["db_writer"].downloaded(file, written)
+                        return
                     logger.error(
                         "Failed to download: %s [Response code: %s]",
                         filename,
                         response.status,
                     )
+                    status = response.status
+                    mirror.fail(status, parse_retry_after(response.headers))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("Download exception for %s: %s", filename, e)
+            status = None
+            mirror.fail()
         except Exception as e:
             logger.exception("Download exception: %s", e)
+            break
+        tried.add(mirror)
+        if not retryable(status) and not mirrors.has_alternative(tried):
+            break
+        if attempt < max_retries:
+            await asyncio.sleep(retry_delay(attempt))
+    metrics["download_failed"] += 1
+
+
+async def save_response(response, file, **kwargs):
+    filename, timestamp, filesize = file.filename, file.timestamp, file.filesize
+    file_path = os.path.join(kwargs["media"], filename.lstrip("/"))
+    # Hidden until complete, so local scans and need_download() never see a partial file
+    temp_path = os.path.join(
+        os.path.dirname(file_path),
+        "." + os.path.basename(file_path) + ".part",
+    )
+    os.umask(0)
+    os.makedirs(os.path.dirname(file_path), mode=0o777, exist_ok=True)
+    try:
+        written = 0
+        async with aiofiles.open(temp_path, "wb") as f:
+            logger.debug("Starting to write file: %s", filename)
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+                written += len(chunk)
+            logger.debug("Finish to write file: %s", filename)
+        if filesize is not None and written != int(filesize):
+            logger.error(
+                "Incomplete download: %s [%d of %s bytes]",
+                filename,
+                written,
+                filesize,
+            )
+            os.remove(temp_path)
+            return None
+        os.chmod(temp_path, 0o777)
+        os.utime(temp_path, (timestamp, timestamp))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
 
 
 async def download_files(files, session, **kwargs):
-    download_tasks = set()
+    folders = {}
     for file in files:
-        if await need_download(file, **kwargs) is True:
-            task = asyncio.create_task(download(file, session, **kwargs))
-            task.add_done_callback(download_tasks.discard)
-            download_tasks.add(task)
-            if len(download_tasks) > 100:
-                await asyncio.gather(*download_tasks)
-    await asyncio.gather(*download_tasks)
+        folders.setdefault(file.folder.dirname, []).append(file)
+    for dirname, folder_files in folders.items():
+        current = await local_files(
+            dirname, set(file.name for file in folder_files), **kwargs
+        )
+        start = time.perf_counter()
+        wanted = [
+            file
+            for file in folder_files
+            if need_download(file, current.get(file.name), kwargs["nfo"])
+        ]
+        metrics["check_seconds"] += time.perf_counter() - start
+        metrics["checked"] += len(folder_files)
+        metrics["skipped"] += len(folder_files) - len(wanted)
+        metrics["checked_folders"] += 1
+        if kwargs.get("db_writer") and wanted:
+            # Checkpointed before queueing, a resumed crawl finishes them
+            await kwargs["db_writer"].pend(wanted)
+        for file in wanted:
+            # Blocks while the download workers are behind, which holds back the crawl
+            await kwargs["download_queue"].put(file)
+
+
+@contextlib.asynccontextmanager
+async def failing_with(tasks):
+    # A watched task that fails cancels the body and its error is raised instead, a
+    # queue that nobody works off anymore would never be joined
+    owner = asyncio.current_task()
+    failures = []
+
+    def check(task):
+        if not task.cancelled() and task.exception() and not failures:
+            failures.append(task.exception())
+            owner.cancel()
+
+    for task in tasks:
+        task.add_done_callback(check)
+    try:
+        yield
+    except asyncio.CancelledError:
+        if not failures:
+            raise
+        owner.uncancel()
+        raise failures[0]
+    finally:
+        for task in tasks:
+            task.remove_done_callback(check)
+    if failures:
+        raise failures[0]
+
+
+async def download_worker(queue, session, **kwargs):
+    while True:
+        file = await queue.get()
+        try:
+            await download(file, session, **kwargs)
+            if kwargs.get("db_writer"):
+                await kwargs["db_writer"].finished(file)
+        finally:
+            queue.task_done()
+
+
+@contextlib.asynccontextmanager
+async def download_pool(session, **kwargs):
+    queue = asyncio.Queue(maxsize=kwargs["downloaders"] * 2)
+    workers = [
+        asyncio.create_task(download_worker(queue, session, **kwargs))
+        for _ in range(kwargs["downloaders"])
+    ]
+    watched = list(workers)
+    if kwargs.get("db_writer"):
+        watched.append(kwargs["db_writer"].task)
+    try:
+        async with failing_with(watched):
+            yield queue
+            await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 
 async def create_table(conn):
     try:
-        async with conn.execute("""
-            CREATE TABLE IF NOT EXISTS files (
-                filename TEXT,
+        async with conn.execute("PRAGMA table_info(files)") as cursor:
+            columns = [column[1] for column in await cursor.fetchall()]
+        if columns and "dir_id" not in columns:
+            # Rows keyed by full path, the crawl they belong to starts over
+            await conn.executescript("""
+                DROP TABLE files;
+                DROP TABLE IF EXISTS downloaded;
+                DROP TABLE IF EXISTS checkpoint;
+            """)
+        # The crawl checkpoint: folders still to list, downloads still to finish and
+        # the finished ones, which are indexed once the crawl is over. A shard also
+        # keeps its listing cache updates here
+        await conn.executescript(FILE_TABLES + """
+            CREATE TABLE IF NOT EXISTS frontier (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER NULL,
+                done INTEGER);
+            CREATE TABLE IF NOT EXISTS pending (
+                filename TEXT PRIMARY KEY,
+                path TEXT,
                 timestamp INTEGER NULL,
-                filesize INTEGER NULL)
-        """):
-            pass
+                filesize INTEGER NULL);
+            CREATE TABLE IF NOT EXISTS downloaded (
+                dir_id INTEGER,
+                name TEXT,
+                timestamp INTEGER NULL,
+                filesize INTEGER NULL,
+                PRIMARY KEY (dir_id, name)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                key TEXT PRIMARY KEY,
+                value);
+            CREATE TABLE IF NOT EXISTS listings (
+                path TEXT PRIMARY KEY,
+                etag TEXT NULL,
+                last_modified TEXT NULL,
+                mtime INTEGER NULL,
+                listing TEXT);
+            CREATE TABLE IF NOT EXISTS listing_mtimes (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER);
+        """)
+        await conn.commit()
     except Exception as e:
         logger.error("Unable to create DB due to %s", e)
         sys.exit(1)
 
 
-async def insert_files(conn, items):
-    await conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", items)
+async def tune_db(conn):
+    await conn.executescript(DB_PRAGMAS)
+
+
+class DBWriter:
+    # Statements run in the order they were queued and a batch commits as a whole,
+    # so every commit is a consistent checkpoint of the crawl
+    FILES = "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)"
+    DOWNLOADED = "INSERT OR REPLACE INTO downloaded VALUES (?, ?, ?, ?)"
+
+    def __init__(self, conn, batch_size=DB_BATCH_SIZE, interval=CHECKPOINT_SECONDS):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dirs = {}
+        self.queue = asyncio.Queue(maxsize=64)
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, rows, statement):
+        if self.task.done():
+            # Surfaces the error that stopped the writer instead of blocking forever
+            self.task.result()
+        if not self.queue.full():
+            self.queue.put_nowait((statement, rows))
+            return
+        # A full queue drains only as long as the writer lives
+        put = asyncio.ensure_future(self.queue.put((statement, rows)))
+        try:
+            await asyncio.wait({put, self.task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put.cancel()
+        if put.cancelled():
+            self.task.result()
+
+    async def visited(self, url, mtime, directories):
+        await self.put(
+            [(urlparse(link).path, timestamp) for link, timestamp in directories],
+            "INSERT OR IGNORE INTO frontier VALUES (?, ?, 0)",
+        )
+        await self.put(
+            [(urlparse(url).path, mtime)],
+            "INSERT OR REPLACE INTO frontier VALUES (?, ?, 1)",
+        )
+
+    async def put_files(self, files):
+        await self.put(
+            [
+                (file.folder.dirname, file.name, file.timestamp, file.filesize)
+                for file in files
+            ],
+            self.FILES,
+        )
+
+    async def pend(self, files):
+        await self.put(
+            [
+                (file.filename, urlparse(file.url).path, file.timestamp, file.filesize)
+                for file in files
+            ],
+            "INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?)",
+        )
+
+    async def finished(self, file):
+        await self.put([(file.filename,)], "DELETE FROM pending WHERE filename = ?")
+
+    async def downloaded(self, file, filesize):
+        await self.put(
+            [(file.folder.dirname, file.name, file.timestamp, filesize)],
+            self.DOWNLOADED,
+        )
+
+    async def complete(self):
+        await self.put(
+            [("complete", 1)], "INSERT OR REPLACE INTO checkpoint VALUES (?, ?)"
+        )
+
+    async def run(self):
+        batch = []
+        size = 0
+        since = None
+        while True:
+            timeout = None
+            if since is not None:
+                timeout = since + self.interval - time.monotonic()
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = ()
+            if item is None:
+                break
+            if item:
+                statement, rows = item
+                if batch and batch[-1][0] == statement:
+                    batch[-1][1].extend(rows)
+                else:
+                    batch.append((statement, list(rows)))
+                size += len(rows)
+                since = since or time.monotonic()
+            if size >= self.batch_size or (
+                since and time.monotonic() - since >= self.interval
+            ):
+                await self.flush(batch)
+                batch = []
+                size = 0
+                since = None
+        if batch:
+            await self.flush(batch)
+
+    async def dir_ids(self, paths):
+        # Looked up by the writer task alone, so a new folder's row always commits
+        # together with its files
+        ids = {path: self.dirs[path] for path in paths if path in self.dirs}
+        missing = set()
+        for path in paths:
+            # The folder itself and the ones above it, so each finds its parent's id
+            while path not in self.dirs and path not in missing:
+                missing.add(path)
+                path = os.path.dirname(path)
+                if path == "/":
+                    break
+        if not missing:
+            return ids
+        missing = sorted(missing)
+        await self.conn.executemany(
+            """
+            INSERT OR IGNORE INTO dirs (parent, path)
+            VALUES ((SELECT id FROM dirs WHERE path = ?), ?)
+        """,
+            [(os.path.dirname(path), path) for path in missing],
+        )
+        found = {}
+        for start in range(0, len(missing), 500):
+            chunk = missing[start : start + 500]
+            marks = ", ".join("?" * len(chunk))
+            async with self.conn.execute(
+                f"SELECT path, id FROM dirs WHERE path IN ({marks})", chunk
+            ) as cursor:
+                found.update(await cursor.fetchall())
+        if len(self.dirs) + len(found) > DIR_CACHE_SIZE:
+            self.dirs.clear()
+        self.dirs.update(found)
+        ids.update(found)
+        return ids
+
+    async def flush(self, batch):
+        start = time.perf_counter()
+        for statement, rows in batch:
+            if statement in (self.FILES, self.DOWNLOADED):
+                # Queued with the folder's path, stored with its id
+                ids = await self.dir_ids(set(row[0] for row in rows))
+                rows = [(ids[row[0]],) + row[1:] for row in rows]
+            await self.conn.executemany(statement, rows)
+            metrics["db_rows"] += len(rows)
+        # The age of a checkpoint counts from its last commit, not from the start
+        await self.conn.execute(
+            "INSERT OR REPLACE INTO checkpoint VALUES ('saved', ?)",
+            (int(time.time()),),
+        )
+        await self.conn.commit()
+        metrics["db_seconds"] += time.perf_counter() - start
+        metrics["db_commits"] += 1
+
+    async def close(self):
+        if not self.task.done():
+            await self.queue.put(None)
+        await self.task
+        logger.info(
+            "Crawl DB: %d rows in %d commits, %.0f rows/s",
+            metrics["db_rows"],
+            metrics["db_commits"],
+            metrics["db_rows"] / metrics["db_seconds"] if metrics["db_seconds"] else 0,
+        )
+
+
+async def checkpoint_state(conn):
+    async with conn.execute("SELECT key, value FROM checkpoint") as cursor:
+        return dict(await cursor.fetchall())
+
+
+def checkpoint_key(url, paths):
+    return json.dumps(
+        [urlparse(url).path] + sorted(unquote(path) for path in paths),
+        ensure_ascii=False,
+    )
+
+
+def resumable(state, url, paths, max_age=CHECKPOINT_MAX_AGE):
+    saved = state.get("saved", state.get("started", 0))
+    return (
+        state.get("paths") == checkpoint_key(url, paths)
+        and time.time() - saved < max_age
+    )
+
+
+async def load_checkpoint(conn, url, paths, resume=True, max_age=CHECKPOINT_MAX_AGE):
+    # Picks up where an unfinished crawl of the same paths stopped, otherwise starts
+    # a new one from the root with an empty crawl DB
+    state = await checkpoint_state(conn)
+    origin = url_origin(url)
+    if resume and resumable(state, url, paths, max_age) and not state.get("complete"):
+        async with conn.execute(
+            "SELECT path, mtime FROM frontier WHERE done = 0"
+        ) as cursor:
+            directories = [
+                (origin + path, mtime) for path, mtime in await cursor.fetchall()
+            ]
+        async with conn.execute(
+            "SELECT path, filename, timestamp, filesize FROM pending"
+        ) as cursor:
+            pending = [
+                RemoteFile.at(origin + path, filename, timestamp, filesize)
+                for path, filename, timestamp, filesize in await cursor.fetchall()
+            ]
+        async with conn.execute(
+            "SELECT COUNT(*) FROM frontier WHERE done = 1"
+        ) as cursor:
+            (done,) = await cursor.fetchone()
+        logger.info(
+            "Resuming the crawl started %s: %d folders done, %d to go, %d downloads pending",
+            datetime.fromtimestamp(state["started"]).strftime("%Y-%m-%d %H:%M"),
+            done,
+            len(directories),
+            len(pending),
+        )
+        return directories, pending
+    await conn.executescript("""
+        DELETE FROM files;
+        DELETE FROM dirs;
+        DELETE FROM frontier;
+        DELETE FROM pending;
+        DELETE FROM downloaded;
+        DELETE FROM checkpoint;
+        DELETE FROM listings;
+        DELETE FROM listing_mtimes;
+    """)
+    await conn.executemany(
+        "INSERT INTO checkpoint VALUES (?, ?)",
+        [
+            ("paths", checkpoint_key(url, paths)),
+            ("started", int(time.time())),
+            ("complete", 0),
+        ],
+    )
+    await conn.execute(
+        "INSERT INTO frontier VALUES (?, NULL, 0)", (urlparse(url).path,)
+    )
     await conn.commit()
+    return [(url, None)], []
 
 
 async def exam_file(file, media):
@@ -331,145 +1734,1182 @@ async def exam_file(file, media):
     return file[len(media) :], int(stat.st_mtime), stat.st_size
 
 
-def process_folder(folder, media):
-    all_items = []
-    for root, dirs, files in os.walk(folder, topdown=False):
-        dirs[:] = [d for d in dirs if d not in s_folder]
-        for file in files:
-            if not file.startswith(".") and not file.lower().endswith(tuple(s_ext)):
-                file_path = os.path.join(root, file)
-                try:
+def scan_directory(folder):
+    files = []
+    dirs = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if entry.name not in s_folder and not entry.is_symlink():
+                        dirs.append(entry.name)
+                elif not entry.name.startswith(".") and not entry.name.lower().endswith(
+                    tuple(s_ext)
+                ):
                     # Attempt to decode the filename to UTF-8
-                    file_path.encode("utf-8")
-                    relative_path = file_path[len(media) :]
-                except UnicodeEncodeError:
-                    # Log if the filename is not UTF-8
-                    logging.error("Filename is not UTF-8 encoded: %s", file_path)
-                    relative_path = None  # Handle or skip the invalid path as needed
-                if relative_path:
-                    all_items.append((relative_path, None, None))
-    return all_items
-
-
-def remove_empty_folders(paths, media):
-    for path in paths:
-        for root, dirs, files in os.walk(
-            unquote(os.path.join(media, path)), topdown=False
-        ):
-            dirs[:] = [d for d in dirs if d not in s_folder]
-            if not dirs and not files:
-                try:
-                    os.rmdir(root)
-                    logger.info("Deleted empty folder: %s", root)
-                except OSError as e:
-                    logger.error("Failed to delete folder %s: %s", root, e)
+                    entry.name.encode("utf-8")
+                    stat = entry.stat()
+                    files.append((entry.name, int(stat.st_mtime), stat.st_size))
+            except UnicodeEncodeError:
+                # Log if the filename is not UTF-8
+                logging.error(
+                    "Filename is not UTF-8 encoded: %s",
+                    os.path.join(folder, entry.name),
+                )
+            except OSError as e:
+                logger.error(
+                    "Unable to stat %s: %s", os.path.join(folder, entry.name), e
+                )
+    return files, dirs
+
+
+def remove_empty_parents(folders, media, paths):
+    roots = ["/" + unquote(path).rstrip("/") for path in paths]
+    removed = 0
+    # Deepest first, so a folder is tried again once its last subfolder is gone
+    for folder in sorted(folders, key=lambda folder: folder.count("/"), reverse=True):
+        while any(folder.startswith(root + "/") for root in roots):
+            try:
+                os.rmdir(media + folder)
+                removed += 1
+                logger.info("Deleted empty folder: %s", media + folder)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+    return removed
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error("Unable to remove %s due to %s", path, e)
+        return False
+    return True
+
+
+async def create_index(conn):
+    try:
+        async with conn.execute("PRAGMA table_info(files)") as cursor:
+            legacy = "dir_id" not in [column[1] for column in await cursor.fetchall()]
+        if legacy:
+            # A file list keyed by full path, or none at all, is rebuilt from scratch
+            await conn.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS dirs;
+            """)
+        await conn.executescript(FILE_TABLES)
+        await conn.commit()
+        return legacy
+    except Exception as e:
+        logger.error("Unable to create DB due to %s", e)
+        sys.exit(1)
 
 
-async def generate_localdb(db, media, paths):
-    logger.warning(
-        "Generating local DB... It takes time depends on the DiskI/O performance... Do NOT quit..."
+async def index_downloads(conn, tempdb):
+    # Indexed in one go after the crawl, so no crawl ever waits on the index's lock
+    await conn.execute("ATTACH DATABASE ? AS crawl", (tempdb,))
+    indexed = 0
+    async with conn.execute("""
+        SELECT folders.path, downloaded.name, downloaded.timestamp, downloaded.filesize
+        FROM crawl.downloaded AS downloaded
+        JOIN crawl.dirs AS folders ON folders.id = downloaded.dir_id
+    """) as cursor:
+        while rows := await cursor.fetchmany(DB_BATCH_SIZE):
+            # Folders created by the download get a record without mtime, so the next
+            # refresh lists them and can drop their files once they disappear
+            dirs = set()
+            for dirname, _, _, _ in rows:
+                while dirname not in ("/", "") and dirname not in dirs:
+                    dirs.add(dirname)
+                    dirname = os.path.dirname(dirname)
+            # Sorted, a parent goes in ahead of its subfolders and they find its id
+            await conn.executemany(
+                """
+                INSERT OR IGNORE INTO main.dirs (parent, path)
+                VALUES ((SELECT id FROM main.dirs WHERE path = ?), ?)
+            """,
+                [(os.path.dirname(dirname), dirname) for dirname in sorted(dirs)],
+            )
+            await conn.executemany(
+                """
+                INSERT OR REPLACE INTO main.files
+                VALUES ((SELECT id FROM main.dirs WHERE path = ?), ?, ?, ?)
+            """,
+                rows,
+            )
+            indexed += len(rows)
+    await conn.commit()
+    await conn.execute("DETACH DATABASE crawl")
+    return indexed
+
+
+def subtree_range(dirname):
+    # Everything below dirname sorts between "dirname/" and "dirname0" as "0" follows "/"
+    return dirname + "/", dirname + "0"
+
+
+def paths_clause(paths, column="path"):
+    # Folder paths in or below the selected paths
+    clauses = []
+    bounds = []
+    for path in paths:
+        root = "/" + unquote(path).rstrip("/")
+        clauses.append(f"({column} = ? OR ({column} >= ? AND {column} < ?))")
+        bounds.extend((root, *subtree_range(root)))
+    return f"({' OR '.join(clauses)})", bounds
+
+
+async def drop_directory(conn, dirname):
+    subtree = "path = ? OR (path >= ? AND path < ?)"
+    bounds = (dirname, *subtree_range(dirname))
+    await conn.execute(
+        f"DELETE FROM files WHERE dir_id IN (SELECT id FROM dirs WHERE {subtree})",
+        bounds,
     )
+    await conn.execute(f"DELETE FROM dirs WHERE {subtree}", bounds)
+
+
+async def store_directory(conn, dirname, parent):
+    # The mtime is left NULL, generate_localdb sets it once the subtree is stored
+    async with conn.execute(
+        """
+        INSERT INTO dirs (parent, path, mtime) VALUES (?, ?, NULL)
+        ON CONFLICT (path) DO UPDATE SET parent = excluded.parent, mtime = NULL
+        RETURNING id
+    """,
+        (parent, dirname),
+    ) as cursor:
+        (dir_id,) = await cursor.fetchone()
+    return dir_id
+
+
+async def generate_localdb(db, media, paths, full=False, workers=8):
     async with aiosqlite.connect(db) as conn:
-        await create_table(conn)
-        for path in paths:
-            logger.info("Processing %s", unquote(os.path.join(media, path)))
-            items = process_folder(unquote(os.path.join(media, path)), media)
-            await insert_files(conn, items)
+        await tune_db(conn)
+        if await create_index(conn):
+            full = True
+        if full:
+            logger.warning(
+                "Generating local DB... It takes time depends on the DiskI/O performance... Do NOT quit..."
+            )
+            await conn.execute("DELETE FROM files")
+            await conn.execute("DELETE FROM dirs")
+        roots = ["/" + unquote(path).rstrip("/") for path in paths]
+        # Forget everything outside the selected paths so it can never be purged by mistake
+        clause, bounds = paths_clause(paths)
+        await conn.execute(
+            f"""
+            DELETE FROM files WHERE dir_id NOT IN (SELECT id FROM dirs WHERE {clause})
+        """,
+            bounds,
+        )
+        known = {}
+        children = {}
+        async with conn.execute("SELECT id, parent, path, mtime FROM dirs") as cursor:
+            async for dir_id, parent, dirname, mtime in cursor:
+                known[dirname] = (dir_id, mtime)
+                children.setdefault(parent, []).append(dirname)
+        for dirname in known:
+            if any(dirname == root or dirname.startswith(root + "/") for root in roots):
+                continue
+            if any(root.startswith(dirname + "/") for root in roots):
+                # Above a selected path, the files below it must stay
+                await conn.execute("DELETE FROM dirs WHERE path = ?", (dirname,))
+            else:
+                await drop_directory(conn, dirname)
+        scanned = 0
+        batch = []
+        # Folders are stored without their mtime until the scan is through, a folder
+        # whose subtree a quit scan left half done is rescanned instead of skipped
+        mtimes = {}
+        unreadable = []
+
+        async def flush():
+            # Folder records commit together with their files, never ahead of them
+            await conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", batch
+            )
+            await conn.commit()
+            batch.clear()
+
+        loop = asyncio.get_running_loop()
+        queue = collections.deque(roots)
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while queue or pending:
+                while queue and len(pending) < workers * 2:
+                    dirname = queue.popleft()
+                    logger.debug("Processing %s", media + dirname)
+                    future = loop.run_in_executor(
+                        executor,
+                        visit_directory,
+                        media,
+                        dirname,
+                        known.get(dirname, (None, None))[1],
+                    )
+                    pending[future] = dirname
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    dirname = pending.pop(future)
+                    try:
+                        mtime, files, subdirs = future.result()
+                    except FileNotFoundError:
+                        await drop_directory(conn, dirname)
+                        continue
+                    except OSError as e:
+                        logger.error("Unable to scan %s: %s", media + dirname, e)
+                        unreadable.append(dirname)
+                        continue
+                    if files is None:
+                        queue.extend(children.get(known[dirname][0], []))
+                        continue
+                    scanned += 1
+                    parent = known.get(os.path.dirname(dirname), (None,))[0]
+                    dir_id = await store_directory(conn, dirname, parent)
+                    known[dirname] = (dir_id, mtime)
+                    mtimes[dirname] = (mtime, dir_id)
+                    if not full:
+                        await drop_stale_files(conn, dir_id, files)
+                    batch.extend(
+                        (dir_id, name, timestamp, filesize)
+                        for name, timestamp, filesize in files
+                    )
+                    subdirs = [dirname + "/" + subdir for subdir in subdirs]
+                    for child in set(children.get(dir_id, [])) - set(subdirs):
+                        await drop_directory(conn, child)
+                    queue.extend(subdirs)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    await flush()
+        await flush()
+        for dirname in unreadable:
+            # The folders above it are rescanned next time to give it another go
+            while dirname not in roots and dirname != "/":
+                dirname = os.path.dirname(dirname)
+                mtimes.pop(dirname, None)
+        await conn.executemany(
+            "UPDATE dirs SET mtime = ? WHERE id = ?", list(mtimes.values())
+        )
+        await conn.commit()
         total_items_count = await get_total_items_count(conn)
-        logger.info("There are %d files on the local disk", total_items_count)
+        logger.info(
+            "There are %d files on the local disk, %d folders rescanned",
+            total_items_count,
+            scanned,
+        )
 
 
-async def get_total_items_count(conn):
-    async with conn.execute("SELECT COUNT(*) FROM files") as cursor:
+def visit_directory(media, dirname, known_mtime):
+    mtime = os.stat(media + dirname).st_mtime_ns
+    if mtime == known_mtime:
+        return mtime, None, None
+    files, subdirs = scan_directory(media + dirname)
+    return mtime, files, subdirs
+
+
+async def drop_stale_files(conn, dir_id, files):
+    names = set(name for name, _, _ in files)
+    async with conn.execute(
+        "SELECT name FROM files WHERE dir_id = ?", (dir_id,)
+    ) as cursor:
+        stale = [
+            (dir_id, name) for (name,) in await cursor.fetchall() if name not in names
+        ]
+    await conn.executemany("DELETE FROM files WHERE dir_id = ? AND name = ?", stale)
+
+
+async def get_total_items_count(conn, paths=None):
+    query = "SELECT COUNT(*) FROM files"
+    bounds = []
+    if paths:
+        clause, bounds = paths_clause(paths)
+        query += f" WHERE dir_id IN (SELECT id FROM dirs WHERE {clause})"
+    async with conn.execute(query, bounds) as cursor:
         result = await cursor.fetchone()
         total_count = result[0] if result else 0
     return total_count
 
 
-async def write_one(url, session, db_session, **kwargs) -> list:
+async def write_one(url, session, db_writer, mtime=None, **kwargs) -> list:
     # This is a hack.. To be compatible with the website with the full data rather than updating ones.
     if urlparse(url).path == "/":
         directories = []
         for path in kwargs["paths"]:
-            directories.append(urljoin(url, path))
+            directories.append((urljoin(url, path), None))
+        # Paths come hottest first, a LIFO frontier pops the last one first
+        if kwargs["order"] == "dfs":
+            directories.reverse()
         return directories
-    files, directories = await parse(url=url, session=session, **kwargs)
+    listing = await parse(url=url, session=session, mtime=mtime, **kwargs)
+    if listing is None:
+        return None
+    files, directories = listing
     if not files:
         return directories
-    if kwargs["media"]:
-        await download_files(files=files, session=session, **kwargs)
-    if db_session:
-        items = []
-        for file in files:
-            items.append(file[1:])
-        await db_session.executemany(
-            "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", items
-        )
-        await db_session.commit()
-        logger.debug("Wrote results for source URL: %s", unquote(url))
+    await store_files(files, session, db_writer, **kwargs)
+    logger.debug("Wrote results for source URL: %s", unquote(url))
     return directories
 
 
-async def bulk_crawl_and_write(url, session, db_session, depth=0, **kwargs) -> None:
-    tasks = set()
-    directories = await write_one(
-        url=url, session=session, db_session=db_session, **kwargs
-    )
-    for url in directories:
-        task = asyncio.create_task(
-            bulk_crawl_and_write(
-                url=url,
-                session=session,
-                db_session=db_session,
-                depth=depth + 1,
+async def store_files(files, session, db_writer, **kwargs):
+    if db_writer:
+        await db_writer.put_files(files)
+    if kwargs["media"]:
+        await download_files(
+            files=files, session=session, db_writer=db_writer, **kwargs
+        )
+
+
+async def listing_worker(frontier, session, db_writer, **kwargs):
+    while True:
+        url, mtime = await frontier.get()
+        try:
+            directories = await write_one(
+                url=url, session=session, db_writer=db_writer, mtime=mtime, **kwargs
+            )
+            if directories is None:
+                # Stays in the checkpoint's frontier, so a resumed crawl lists it again
+                metrics["listing_failed"] += 1
+                continue
+            if db_writer:
+                await db_writer.visited(url, mtime, directories)
+            for directory in directories:
+                frontier.put_nowait(directory)
+            metrics["listed"] += 1
+            metrics["frontier_peak"] = max(metrics["frontier_peak"], frontier.qsize())
+        except Exception as e:
+            logger.exception("Crawl exception for %s: %s", unquote(url), e)
+            metrics["listing_failed"] += 1
+        finally:
+            frontier.task_done()
+
+
+async def report_progress(frontier, download_queue, interval=30):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(
+            "Progress: %d folders listed, %d queued; %d files downloaded, %d queued",
+            metrics["listed"],
+            frontier.qsize(),
+            metrics["downloaded"],
+            download_queue.qsize(),
+        )
+
+
+async def bulk_crawl_and_write(
+    url, session, db_writer, resume=None, **kwargs
+) -> bool:
+    # LIFO keeps the frontier as small as the tree is deep, FIFO as wide as it is wide
+    if kwargs["order"] == "dfs":
+        frontier = asyncio.LifoQueue()
+    else:
+        frontier = asyncio.Queue()
+    directories, pending = resume or ([(url, None)], [])
+    for directory in directories:
+        frontier.put_nowait(directory)
+    failed = metrics["listing_failed"]
+    async with download_pool(
+        session, db_writer=db_writer, **kwargs
+    ) as download_queue:
+        if pending:
+            await download_files(
+                pending,
+                session,
+                db_writer=db_writer,
+                download_queue=download_queue,
                 **kwargs,
             )
+        workers = [
+            asyncio.create_task(
+                listing_worker(
+                    frontier,
+                    session,
+                    db_writer,
+                    download_queue=download_queue,
+                    **kwargs,
+                )
+            )
+            for _ in range(kwargs["crawlers"])
+        ]
+        reporter = asyncio.create_task(report_progress(frontier, download_queue))
+        try:
+            async with failing_with(workers):
+                await frontier.join()
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(reporter, *workers, return_exceptions=True)
+    logger.info(
+        "Crawled %d folders with %d listing and %d download workers, the frontier peaked at %d",
+        metrics["listed"],
+        kwargs["crawlers"],
+        kwargs["downloaders"],
+        metrics["frontier_peak"],
+    )
+    failed = metrics["listing_failed"] - failed
+    if failed:
+        logger.warning(
+            "%d folders could not be listed, the crawl is incomplete", failed
         )
-        task.add_done_callback(tasks.discard)
-        tasks.add(task)
-        if depth == 0:
-            await asyncio.gather(*tasks)
-    await asyncio.gather(*tasks)
+    return not failed
+
+
+async def sync_from_manifest(
+    url, session, db_writer, manifest, resume=None, **kwargs
+) -> bool:
+    # The entries are counted into manifest on the way, the list is fetched only once
+    files = []
+    folder = None
+    complete = False
+    amount = -1
+    async with download_pool(
+        session, db_writer=db_writer, **kwargs
+    ) as download_queue:
+        # The list has no frontier to resume, only the downloads that were cut short
+        if resume and resume[1]:
+            await download_files(
+                resume[1],
+                session,
+                db_writer=db_writer,
+                download_queue=download_queue,
+                **kwargs,
+            )
+        for mirror in kwargs["mirrors"].mirrors:
+            try:
+                amount = 0
+                async for filename, timestamp in stream_manifest(
+                    session, mirror.url + MANIFEST, kwargs["paths"]
+                ):
+                    amount += 1
+                    abslink = urljoin(url, quote(filename.lstrip("/")))
+                    # The list goes folder by folder, its files share one record
+                    file = RemoteFile.at(abslink, filename, timestamp, None, folder)
+                    folder = file.folder
+                    files.append(file)
+                    if len(files) >= 1000:
+                        await store_files(
+                            files,
+                            session,
+                            db_writer,
+                            download_queue=download_queue,
+                            **kwargs,
+                        )
+                        files = []
+                logger.info("There are %d files in %s", amount, mirror.url)
+                complete = True
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+                # Entries already queued come again from the next mirror, which is harmless
+                logger.error("Unable to read the file list from %s: %s", mirror.url, e)
+                amount = -1
+        manifest.set_result(amount)
+        if files:
+            await store_files(
+                files, session, db_writer, download_queue=download_queue, **kwargs
+            )
+    return complete
+
+
+def shard_db(db_location, path):
+    # One crawl DB per path, a resumed run finds it whichever shard the path lands in
+    name = "%08x" % zlib.crc32(unquote(path).encode())
+    return os.path.join(db_location, f".tempfiles.{name}.db")
+
+
+def remove_db(db):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+
+
+def assign_shards(paths, weights, shards):
+    # Heaviest first onto the lightest shard, so no shard runs much longer than the rest
+    loads = [[0, []] for _ in range(shards)]
+    for path in sorted(paths, key=lambda path: -weights.get(path, 0)):
+        lightest = min(loads, key=lambda load: load[0])
+        lightest[0] += weights.get(path, 0) or 1
+        lightest[1].append(path)
+    return [assigned for _, assigned in loads if assigned]
+
 
+def shard_mirrors(mirrors, shard, shards, limit, pin=False):
+    # Every shard gets its share of the per mirror limit, the mirror sees no more load
+    pool = mirrors.mirrors
+    sharing = shards
+    if pin:
+        pool = [pool[shard % len(pool)]]
+        sharing = len(range(shard % len(mirrors.mirrors), shards, len(mirrors.mirrors)))
+    return [(m.url, max(1, limit // sharing), m.latency) for m in pool]
 
-async def compare_databases(localdb, tempdb, total_amount):
-    async with aiosqlite.connect(localdb) as conn1, aiosqlite.connect(tempdb) as conn2:
-        cursor1 = await conn1.cursor()
-        cursor2 = await conn2.cursor()
 
-        await cursor1.execute("SELECT filename FROM files")
-        local_filenames = set(filename[0] for filename in await cursor1.fetchall())
+def run_shard(shard, paths, settings, results):
+    # Entry point of a shard process, which crawls its paths on a loop of its own
+    try:
+        results.send(asyncio.run(crawl_shard(shard, paths, **settings)))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        results.close()
+
+
+def shard_result(process, results):
+    try:
+        return results.recv()
+    except EOFError:
+        return None
+    finally:
+        process.join()
+
+
+async def crawl_shard(
+    shard, paths, args, crawl, count, mirrors, db_location, localdb
+):
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(
+            logging.Formatter(
+                f"%(asctime)s %(levelname)s [shard {shard}] %(message)s",
+                datefmt="%Y-%m-%d %H:%M:%S",
+            )
+        )
+    if args.debug:
+        logging.getLogger("emd").setLevel(logging.DEBUG)
+    # The coordinator stops a shard with SIGTERM and a shard whose coordinator died
+    # stops by itself, either way the crawl DB is flushed on the way out
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    sentinel = multiprocessing.parent_process().sentinel
+
+    def orphaned():
+        # Stays readable once the coordinator is gone, one cancel is enough
+        loop.remove_reader(sentinel)
+        task.cancel()
+
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    loop.add_reader(sentinel, orphaned)
+    mirrors = MirrorPool([Mirror(*mirror) for mirror in mirrors])
+    url = mirrors.base
+    complete = {}
+    async with contextlib.AsyncExitStack() as closing:
+        session = await closing.enter_async_context(
+            ClientSession(
+                connector=TCPConnector(ssl=False, limit=0, ttl_dns_cache=600),
+                timeout=aiohttp.ClientTimeout(total=36000),
+            )
+        )
+        # Both only read here, the coordinator merges the writes after the crawl
+        index_session = None
+        if localdb:
+            index_session = await aiosqlite.connect(localdb)
+            closing.push_async_callback(index_session.close)
+        listing_cache = None
+        if args.cache:
+            listing_cache = await aiosqlite.connect(
+                os.path.join(db_location, ".listings.db")
+            )
+            closing.push_async_callback(listing_cache.close)
+        semaphore = asyncio.Semaphore(count)
+        for path in paths:
+            async with aiosqlite.connect(shard_db(db_location, path)) as conn:
+                await tune_db(conn)
+                await create_table(conn)
+                state = await checkpoint_state(conn)
+                if (
+                    args.resume
+                    and resumable(state, url, [path], args.resume_max_age)
+                    and state["complete"]
+                ):
+                    logger.info("%s was crawled by an earlier run", unquote(path))
+                    complete[path] = True
+                    continue
+                logger.info("Crawling %s...", unquote(path))
+                resume = await load_checkpoint(
+                    conn,
+                    url,
+                    [path],
+                    resume=args.resume,
+                    max_age=args.resume_max_age,
+                )
+                db_writer = DBWriter(conn)
+                try:
+                    complete[path] = await bulk_crawl_and_write(
+                        url=url,
+                        session=session,
+                        db_writer=db_writer,
+                        listing_writer=db_writer,
+                        semaphore=semaphore,
+                        paths=[path],
+                        index_session=index_session,
+                        listing_cache=listing_cache,
+                        mirrors=mirrors,
+                        resume=resume,
+                        **crawl,
+                    )
+                    if complete[path]:
+                        await db_writer.complete()
+                finally:
+                    await db_writer.close()
+        mirrors.report()
+    return (
+        complete,
+        metrics.counters,
+        metrics.changes,
+        metrics.histograms,
+        metrics.first_download,
+    )
+
 
-        await cursor2.execute("SELECT filename FROM files")
-        temp_filenames = set(filename[0] for filename in await cursor2.fetchall())
-        gap = abs(len(temp_filenames) - total_amount)
+async def crawl_in_shards(
+    args, paths, crawl, index_session, indexed=True, **kwargs
+):
+    joining = kwargs["mirrors"].joining
+    if joining:
+        # A mirror that joins after the shards started never reaches them
+        await asyncio.wait({joining}, timeout=JOIN_WAIT_SECONDS)
+    weights = {}
+    if index_session:
+        # What the last run found on disk is the best guess of how large each path is
+        for path in paths:
+            weights[path] = await get_total_items_count(index_session, [path])
+    assignment = assign_shards(paths, weights, args.shards)
+    settings = dict(
+        args=args,
+        db_location=kwargs["db_location"],
+        localdb=None,
+    )
+    if index_session and indexed:
+        settings["localdb"] = os.path.join(kwargs["db_location"], ".localfiles.db")
+    context = multiprocessing.get_context("spawn")
+    running = []
+    for shard, assigned in enumerate(assignment):
+        logger.info(
+            "Shard %d: %s", shard, ", ".join(unquote(path) for path in assigned)
+        )
+        results, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=run_shard,
+            args=(
+                shard,
+                assigned,
+                dict(
+                    settings,
+                    crawl=crawl,
+                    count=max(1, args.count // len(assignment)),
+                    mirrors=shard_mirrors(
+                        kwargs["mirrors"],
+                        shard,
+                        len(assignment),
+                        args.mirror_count,
+                        pin=args.shard_mirrors,
+                    ),
+                ),
+                sender,
+            ),
+            name=f"shard-{shard}",
+        )
+        process.start()
+        sender.close()
+        running.append((process, results))
+    try:
+        shards = await asyncio.gather(
+            *(asyncio.to_thread(shard_result, *shard) for shard in running)
+        )
+    finally:
+        for process, _ in running:
+            if process.is_alive():
+                process.terminate()
+    complete = {}
+    for result in shards:
+        if result is None:
+            logger.error("A shard stopped before its crawl was done")
+            continue
+        done, counters, changes, histograms, first_download = result
+        complete.update(done)
+        metrics.merge(counters, changes, histograms, first_download)
+    return all(complete.get(path) for path in paths)
+
+
+async def merge_shard(db, conn, listing_cache):
+    # Rows of the later shard win, which is fine, the paths of two shards never overlap
+    if conn:
+        await conn.execute("ATTACH DATABASE ? AS shard", (db,))
+        # Folder ids differ between the DBs, rows are matched up by folder path
+        async with conn.execute(
+            "SELECT id, parent, path FROM shard.dirs ORDER BY id"
+        ) as cursor:
+            dirs = await cursor.fetchall()
+        parents = {dir_id: path for dir_id, _, path in dirs}
+        # A shard's parents have the lower ids, they go in ahead of their subfolders
+        await conn.executemany(
+            """
+            INSERT OR IGNORE INTO main.dirs (parent, path)
+            VALUES ((SELECT id FROM main.dirs WHERE path = ?), ?)
+        """,
+            [(parents.get(parent), path) for _, parent, path in dirs],
+        )
+        for table in ("files", "downloaded"):
+            await conn.execute(f"""
+                INSERT OR REPLACE INTO main.{table}
+                SELECT folders.id, source.name, source.timestamp, source.filesize
+                FROM shard.{table} AS source
+                JOIN shard.dirs AS shard_folders ON shard_folders.id = source.dir_id
+                JOIN main.dirs AS folders ON folders.path = shard_folders.path
+            """)
+        await conn.commit()
+        await conn.execute("DETACH DATABASE shard")
+    if listing_cache:
+        await listing_cache.commit()
+        await listing_cache.execute("ATTACH DATABASE ? AS shard", (db,))
+        await listing_cache.execute(
+            "INSERT OR REPLACE INTO listings SELECT * FROM shard.listings"
+        )
+        await listing_cache.execute("""
+            UPDATE listings SET mtime = (
+                SELECT mtime FROM shard.listing_mtimes AS touched
+                WHERE touched.path = listings.path)
+            WHERE path IN (SELECT path FROM shard.listing_mtimes)
+        """)
+        await listing_cache.commit()
+        await listing_cache.execute("DETACH DATABASE shard")
+
+
+async def compare_databases(localdb, tempdb, total_amount, paths):
+    # Only the crawled paths, the local DB also holds the ones synced on other runs
+    clause, bounds = paths_clause(paths)
+    async with aiosqlite.connect(localdb) as conn:
+        await conn.execute("ATTACH DATABASE ? AS crawl", (tempdb,))
+        async with conn.execute(
+            f"""
+            SELECT COUNT(*) FROM crawl.files
+            WHERE dir_id IN (SELECT id FROM crawl.dirs WHERE {clause})
+        """,
+            bounds,
+        ) as cursor:
+            (crawled,) = await cursor.fetchone()
+        gap = abs(crawled - total_amount)
 
         if gap < 10 and total_amount > 0:
             if not gap == 0:
                 logger.warning(
                     "Total amount do not match: %d -> %d. But the gap %d is less than 10, purging anyway...",
                     total_amount,
-                    len(temp_filenames),
-                    abs(len(temp_filenames) - total_amount),
+                    crawled,
+                    gap,
                 )
-            diff_filenames = local_filenames - temp_filenames
-            return diff_filenames
         else:
             logger.error(
                 "Total amount do not match: %d -> %d. Purges are skipped",
                 total_amount,
-                len(temp_filenames),
+                crawled,
             )
-            return []
+            return
+        # Anti-join on folder path and the crawl DB's primary key, streamed so memory
+        # stays flat
+        clause, bounds = paths_clause(paths, "local_folders.path")
+        async with conn.execute(
+            f"""
+            SELECT local_folders.path, local.name FROM main.dirs AS local_folders
+            JOIN main.files AS local ON local.dir_id = local_folders.id
+            WHERE {clause} AND NOT EXISTS (
+                SELECT 1 FROM crawl.dirs AS crawled_folders
+                JOIN crawl.files AS crawled ON crawled.dir_id = crawled_folders.id
+                WHERE crawled_folders.path = local_folders.path
+                AND crawled.name = local.name)
+        """,
+            bounds,
+        ) as cursor:
+            while rows := await cursor.fetchmany(PURGE_BATCH_SIZE):
+                yield [dirname + "/" + name for dirname, name in rows]
+
+
+async def purge_removed_files(
+    localdb, tempdb, media, total_amount, paths, workers=8
+):
+    loop = asyncio.get_running_loop()
+    folders = set()
+    purged_count = 0
+    # A second connection deletes while the diff reads, WAL keeps the reader's snapshot
+    async with aiosqlite.connect(localdb) as conn:
+        await tune_db(conn)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            async for files in compare_databases(
+                localdb, tempdb, total_amount, paths
+            ):
+                results = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(executor, remove_file, media + file)
+                        for file in files
+                    )
+                )
+                purged = []
+                for file, removed in zip(files, results):
+                    if removed:
+                        logger.info("Purged %s", file)
+                        purged.append(os.path.split(file))
+                        metrics.changes[owning_path(file, paths)] += 1
+                        folders.add(os.path.dirname(file))
+                await conn.executemany(
+                    """
+                    DELETE FROM files
+                    WHERE dir_id = (SELECT id FROM dirs WHERE path = ?) AND name = ?
+                """,
+                    purged,
+                )
+                await conn.commit()
+                purged_count += len(purged)
+    return purged_count, folders
+
+
+async def create_proxy_cache(conn):
+    await tune_db(conn)
+    async with conn.execute("PRAGMA table_info(proxy)") as cursor:
+        columns = [column[1] for column in await cursor.fetchall()]
+    if columns and "size" not in columns:
+        # A cache without sizes can't be capped, it is refilled from the mirrors
+        await conn.execute("DROP TABLE proxy")
+    await conn.executescript("""
+        CREATE TABLE IF NOT EXISTS proxy (
+            path TEXT PRIMARY KEY,
+            etag TEXT NULL,
+            last_modified TEXT NULL,
+            content_type TEXT NULL,
+            digest TEXT,
+            fetched REAL,
+            changed REAL,
+            size INTEGER,
+            used REAL);
+    """)
+    await conn.commit()
+
+
+class Proxy:
+    # Serves the mirrors' tree from a disk cache, instances on the LAN that point
+    # --url at it share one upstream fetch of every listing and file
+    def __init__(self, session, mirrors, folder, conn, ttl, max_size=0):
+        self.session = session
+        self.mirrors = mirrors
+        self.folder = folder
+        self.conn = conn
+        self.ttl = ttl
+        self.inflight = {}
+        # Bytes on disk and the cap that starts a sweep of the least recently used
+        self.size = 0
+        self.max_size = max_size
+        # When the entries served since the last sweep were last used
+        self.used = {}
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.revalidated = 0
+        self.fetched = 0
+        self.stale = 0
+        self.evicted = 0
+        self.bytes = 0
+
+    def touch(self, path):
+        if self.max_size:
+            self.used[path] = time.time()
+
+    def body(self, path):
+        digest = hashlib.sha1(path.encode()).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest)
+
+    async def entry(self, path):
+        # One round trip to the DB thread, every cache hit pays for it
+        rows = await self.conn.execute_fetchall(
+            """
+            SELECT etag, last_modified, content_type, digest, fetched, changed, size
+            FROM proxy WHERE path = ?
+        """,
+            (path,),
+        )
+        return rows[0] if rows else None
+
+    async def handle(self, request):
+        self.requests += 1
+        metrics["proxy_requests"] += 1
+        raw_path = request.rel_url.raw_path
+        path = unquote(raw_path)
+        fetch = self.inflight.get(path)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self.refresh(path, raw_path))
+            self.inflight[path] = fetch
+            fetch.add_done_callback(lambda _: self.inflight.pop(path, None))
+        else:
+            # Clients asking for the same URL wait for the one upstream fetch
+            self.coalesced += 1
+            metrics["proxy_coalesced"] += 1
+        # Shielded, a client that hangs up doesn't cancel the fetch others wait for
+        status, content_type = await asyncio.shield(fetch)
+        if status != 200:
+            return web.Response(status=status)
+        # Conditional and range requests are answered from the cached body
+        return web.FileResponse(
+            self.body(path),
+            headers={"Content-Type": content_type or "application/octet-stream"},
+        )
 
+    async def fresh(self, path, entry):
+        fetched = entry[4]
+        parent = path[: path.rstrip("/").rfind("/") + 1]
+        if path.endswith("/") or parent == "/":
+            # Listings and the files at the top, e.g. the manifest, live for the TTL
+            return time.time() - fetched < self.ttl
+        # Other files are as fresh as the listing the clients took them from
+        listing = await self.entry(parent)
+        return (
+            listing is not None
+            and time.time() - listing[4] < self.ttl
+            and listing[5] < fetched
+        )
 
-async def purge_removed_files(localdb, tempdb, media, total_amount):
-    for file in await compare_databases(localdb, tempdb, total_amount):
-        logger.info("Purged %s", file)
+    async def refresh(self, path, raw_path, max_retries=3):
+        try:
+            return await self.fetch(path, raw_path, max_retries)
+        except Exception as e:
+            logger.exception("Proxy exception for %s: %s", path, e)
+            return 502, None
+
+    async def fetch(self, path, raw_path, max_retries):
+        entry = await self.entry(path)
+        if entry and not os.path.exists(self.body(path)):
+            entry = None
+        if entry and await self.fresh(path, entry):
+            self.hits += 1
+            metrics["proxy_hits"] += 1
+            self.touch(path)
+            return 200, entry[2]
+        headers = {"User-Agent": CUSTOM_USER_AGENT}
+        if entry and entry[0]:
+            headers["If-None-Match"] = entry[0]
+        if entry and entry[1]:
+            headers["If-Modified-Since"] = entry[1]
+        tried = set()
+        answers = {}
+        for attempt in range(1, max_retries + 1):
+            mirror = self.mirrors.pick(exclude=tried)
+            try:
+                async with mirror.slot():
+                    start = time.perf_counter()
+                    url = mirror.url + raw_path.lstrip("/")
+                    async with self.session.get(url, headers=headers) as response:
+                        first_byte = time.perf_counter() - start
+                        status = response.status
+                        if status == 304 and entry:
+                            mirror.record(first_byte)
+                            self.revalidated += 1
+                            metrics["proxy_revalidated"] += 1
+                            await self.conn.execute(
+                                "UPDATE proxy SET fetched = ? WHERE path = ?",
+                                (time.time(), path),
+                            )
+                            await self.conn.commit()
+                            self.touch(path)
+                            return 200, entry[2]
+                        if status == 200:
+                            size = await self.store(path, response, entry)
+                            mirror.record(time.perf_counter() - start, size, first_byte)
+                            self.fetched += 1
+                            self.bytes += size
+                            metrics["proxy_fetched"] += 1
+                            return 200, response.headers.get("Content-Type")
+                        mirror.fail(status, parse_retry_after(response.headers))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("Proxy fetch of %s failed: %s", path, e)
+                status = None
+                mirror.fail()
+            answers[mirror] = status
+            tried.add(mirror)
+            if not retryable(status) and not self.mirrors.has_alternative(tried):
+                break
+            # Asking another mirror after a 404 needs no backoff
+            if attempt < max_retries and retryable(status):
+                await asyncio.sleep(retry_delay(attempt))
+        answer = unanimous(answers)
+        if not retryable(answer):
+            # Only what every mirror reached agrees on is passed on, the clients see
+            # the 404 and purge like they would without the proxy
+            if answer == 404 and entry:
+                await self.drop([(path, entry[6])])
+            return answer, None
+        if entry:
+            logger.warning("Upstream failed for %s, serving the cached copy", path)
+            self.stale += 1
+            metrics["proxy_stale"] += 1
+            self.touch(path)
+            return 200, entry[2]
+        return 502, None
+
+    async def store(self, path, response, entry):
+        body = self.body(path)
+        temp_path = body + ".part"
+        os.makedirs(os.path.dirname(body), exist_ok=True)
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            digest = digest.hexdigest()
+            now = changed = time.time()
+            removed = []
+            if entry and entry[3] == digest:
+                # Same bytes, the cached body keeps its mtime the clients validate with
+                os.remove(temp_path)
+                changed = entry[5]
+            else:
+                if entry and path.endswith("/"):
+                    removed = await self.unlisted(str(response.url), body, temp_path)
+                os.replace(temp_path, body)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        await self.conn.execute(
+            "INSERT OR REPLACE INTO proxy VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                response.headers.get("Content-Type"),
+                digest,
+                now,
+                changed,
+                size,
+                now,
+            ),
+        )
+        await self.conn.commit()
+        self.size += size - (entry[6] if entry else 0)
+        if removed:
+            await self.evict_unlisted(path, removed)
+        if self.max_size and self.size > self.max_size:
+            await self.sweep()
+        return size
+
+    async def unlisted(self, url, old, new):
+        # The names the old copy of a listing had and the new one has not
+        names = []
         try:
-            os.remove(media + file)
+            for body in (old, new):
+                async with aiofiles.open(body, "rb") as f:
+                    html = (await f.read()).decode("utf-8", errors="replace")
+                files, directories = parse_listing(url, html)
+                names.append(
+                    {file.name for file in files}
+                    | {unquote(link[len(url) :]) for link, _ in directories}
+                )
         except Exception as e:
-            logger.error("Unable to remove %s due to %s", file, e)
+            logger.error("Unable to compare the listings of %s: %s", unquote(url), e)
+            return set()
+        return names[0] - names[1]
+
+    async def evict_unlisted(self, path, removed):
+        # Removed upstream, the clients purge them and nobody asks for them again
+        rows = []
+        for name in removed:
+            child = path + name
+            subtree = "path = ?"
+            bounds = (child,)
+            if child.endswith("/"):
+                subtree = "path >= ? AND path < ?"
+                bounds = subtree_range(child.rstrip("/"))
+            rows += await self.conn.execute_fetchall(
+                f"SELECT path, size FROM proxy WHERE {subtree}", bounds
+            )
+        if rows:
+            logger.info("Proxy: %d entries no longer listed in %s", len(rows), path)
+            await self.drop(rows)
+
+    async def sweep(self):
+        # Down to 90% of the cap, so the next few fetches don't start another sweep
+        await self.conn.executemany(
+            "UPDATE proxy SET used = ? WHERE path = ?",
+            [(used, path) for path, used in self.used.items()],
+        )
+        self.used.clear()
+        target = self.max_size * 0.9
+        freed = 0
+        rows = []
+        async with self.conn.execute(
+            "SELECT path, size FROM proxy ORDER BY used"
+        ) as cursor:
+            async for path, size in cursor:
+                if self.size - freed <= target:
+                    break
+                if path in self.inflight:
+                    continue
+                rows.append((path, size))
+                freed += size
+        logger.info(
+            "Proxy cache over %.1f MiB, evicting %d entries (%.1f MiB)",
+            self.max_size / 1048576,
+            len(rows),
+            freed / 1048576,
+        )
+        await self.drop(rows)
+
+    async def drop(self, rows):
+        await self.conn.executemany(
+            "DELETE FROM proxy WHERE path = ?", [(path,) for path, _ in rows]
+        )
+        await self.conn.commit()
+        for path, size in rows:
+            remove_file(self.body(path))
+            self.used.pop(path, None)
+            self.size -= size
+            self.evicted += 1
+            metrics["proxy_evicted"] += 1
+
+    def report(self):
+        logger.info(
+            "Proxy: %d requests, %d cache hits, %d coalesced, %d revalidated, %d fetched (%.1f MiB), %d served stale, %d evicted",
+            self.requests,
+            self.hits,
+            self.coalesced,
+            self.revalidated,
+            self.fetched,
+            self.bytes / 1048576,
+            self.stale,
+            self.evicted,
+        )
+        self.mirrors.report()
+
+
+async def start_proxy(port, session, mirrors, db_location, ttl, max_size=0):
+    conn = await aiosqlite.connect(os.path.join(db_location, ".proxy.db"))
+    await create_proxy_cache(conn)
+    proxy = Proxy(
+        session, mirrors, os.path.join(db_location, ".proxy"), conn, ttl, max_size
+    )
+    ((proxy.size,),) = await conn.execute_fetchall(
+        "SELECT COALESCE(SUM(size), 0) FROM proxy"
+    )
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", proxy.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(
+        "Serving %s as a caching proxy on port %d",
+        ", ".join(m.url for m in mirrors.mirrors),
+        port,
+    )
+    return runner, proxy
+
+
+async def stop_proxy(runner, proxy):
+    await runner.cleanup()
+    proxy.report()
+    await proxy.conn.close()
 
 
 def test_media_folder(media, paths):
@@ -529,7 +2969,7 @@ def get_paths_from_bitmap(bitmap, paths_all):
     return selected_paths
 
 
-async def main():
+def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--media",
@@ -546,6 +2986,33 @@ async def main():
         default=100,
         help="Max concurrent HTTP Requests [Default: %(default)s]",
     )
+    parser.add_argument(
+        "--mirror-count",
+        metavar="[number]",
+        type=int,
+        default=20,
+        help="Max concurrent HTTP Requests per mirror [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--crawlers",
+        metavar="[number]",
+        type=int,
+        default=20,
+        help="Folders listed in parallel [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--downloaders",
+        metavar="[number]",
+        type=int,
+        default=50,
+        help="Files downloaded in parallel [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["dfs", "bfs"],
+        default="dfs",
+        help="Crawl depth-first or breadth-first [Default: %(default)s]",
+    )
     parser.add_argument(
         "--debug",
         action=argparse.BooleanOptionalAction,
@@ -596,6 +3063,104 @@ async def main():
         required=None,
         help="Path to store database files [Default: %(default)s]",
     )
+    parser.add_argument(
+        "--scan-workers",
+        metavar="[number]",
+        type=int,
+        default=8,
+        help="Max concurrent local disk operations when building the local DB or purging [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=True,
+        help="Revalidate cached directory listings instead of downloading them again [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--full-crawl-days",
+        metavar="[number]",
+        type=int,
+        default=7,
+        help="Days between crawls that also revisit folders with an unchanged timestamp, 0 never skips them [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=True,
+        help="Resume an interrupted crawl instead of starting over, needs --db or --purge [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--resume-max-age",
+        metavar="[seconds]",
+        type=int,
+        default=CHECKPOINT_MAX_AGE,
+        help="Seconds since its last checkpoint after which an interrupted crawl starts over, keep it above the time between runs [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        metavar="[number]",
+        type=int,
+        default=0,
+        help="Processes that parse large directory listings off the event loop, 0 parses them in the loop [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--shards",
+        metavar="[number]",
+        type=int,
+        default=0,
+        help="Processes that crawl the selected paths side by side, each with its own connections and a share of --count, 0 crawls in this process [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--shard-mirrors",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=False,
+        help="Pin every shard to a mirror of its own instead of sharing all of them [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--manifest",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=False,
+        help="Sync from .scan.list.gz instead of crawling directory listings [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        metavar="[port]",
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics at /metrics on this port during the run, 0 disables it [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="<file>",
+        type=str,
+        default=None,
+        help="Write a JSON summary of the run here [Default: .metrics.json in the DB folder]",
+    )
+    parser.add_argument(
+        "--proxy",
+        metavar="[port]",
+        type=int,
+        default=0,
+        help="Serve the mirrors on this port with listings and files cached in the DB folder, other instances on the LAN use it as their --url. Without --daemon this instance only serves, 0 disables it [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--proxy-ttl",
+        metavar="[seconds]",
+        type=int,
+        default=300,
+        help="Seconds the proxy serves a cached listing before it revalidates it upstream [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--proxy-max-size",
+        metavar="[MiB]",
+        type=int,
+        default=0,
+        help="Size the proxy cache may grow to before the least recently used entries are evicted, 0 lets it hold the whole tree [Default: %(default)s]",
+    )
     parser.add_argument(
         "--paths",
         metavar="<file>",
@@ -603,7 +3168,449 @@ async def main():
         help="Bitmap of paths or a file containing paths to be selected (See paths.example)",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--daemon",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=False,
+        help="Keep running and sync on a schedule, SIGUSR1 starts a sync right away [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--interval",
+        metavar="[seconds]",
+        type=int,
+        default=86400,
+        help="Seconds between syncs in daemon mode [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--path-interval",
+        metavar="<path>=<seconds>",
+        action="append",
+        default=[],
+        help="Seconds between syncs of one path in daemon mode, e.g. 每日更新=3600, can be repeated",
+    )
+    parser.add_argument(
+        "--tiers",
+        action=argparse.BooleanOptionalAction,
+        type=bool,
+        default=False,
+        help="Sync hot paths every --interval/4, warm ones every --interval and cold ones every 7 --interval, learned from how often they change [Default: %(default)s]",
+    )
+    parser.add_argument(
+        "--tier",
+        metavar="<path>=<tier>",
+        action="append",
+        default=[],
+        help="Pin a path to the hot, warm or cold tier, e.g. ISO=cold, can be repeated",
+    )
+    return parser.parse_args()
+
+
+def owning_path(filename, paths):
+    for path in paths:
+        if filename.startswith("/" + unquote(path)):
+            return path
+    return None
+
+
+def learned_tier(history):
+    # How often a sync found something to download or purge, per day
+    if not history:
+        return None
+    days = (history[-1][0] - history[0][0]) / 86400
+    if days < 3:
+        return None
+    rate = sum(1 for _, changes in history if changes) / days
+    if rate >= 0.5:
+        return "hot"
+    if rate < 1 / 14 and days >= 14:
+        return "cold"
+    return "warm"
+
+
+def parse_tiers(args, paths):
+    tiers = {}
+    for item in args.tier:
+        name, _, tier = item.rpartition("=")
+        path = quote(name.strip("/") + "/")
+        if path not in paths or tier not in TIER_FACTORS:
+            logger.error(
+                "Invalid --tier %s, the path must be selected and the tier one of %s",
+                item,
+                ", ".join(TIER_FACTORS),
+            )
+            sys.exit(1)
+        tiers[path] = tier
+    return tiers
+
+
+async def path_tiers(args, paths, listing_cache):
+    tiers = parse_tiers(args, paths)
+    for path in paths:
+        if path in tiers:
+            continue
+        learned = None
+        if listing_cache:
+            learned = learned_tier(await change_history(listing_cache, path))
+        tiers[path] = learned or DEFAULT_TIERS.get(unquote(path), "warm")
+    return tiers
+
+
+def log_tiers(tiers, intervals):
+    for tier in TIER_FACTORS:
+        members = [path for path in tiers if tiers[path] == tier]
+        if members:
+            logger.info(
+                "Tier %s: %s",
+                tier,
+                ", ".join(
+                    "%s every %.1fh" % (unquote(path), intervals[path] / 3600)
+                    for path in members
+                ),
+            )
+
+
+async def due_paths(args, paths, listing_cache):
+    tiers = await path_tiers(args, paths, listing_cache)
+    intervals = parse_intervals(args, paths, tiers)
+    log_tiers(tiers, intervals)
+    due = []
+    for path in paths:
+        synced = await last_synced(listing_cache, path) if listing_cache else 0
+        # Runs started by a fixed cycle finish a bit later each time, allow for it
+        if time.time() - synced >= intervals[path] * 0.9:
+            due.append(path)
+    return by_tier(due, tiers)
+
+
+def by_tier(paths, tiers):
+    return sorted(paths, key=lambda path: list(TIER_FACTORS).index(tiers[path]))
+
+
+def parse_intervals(args, paths, tiers=None):
+    intervals = {
+        path: int(args.interval * TIER_FACTORS[tiers[path]]) if tiers else args.interval
+        for path in paths
+    }
+    for item in args.path_interval:
+        name, _, seconds = item.rpartition("=")
+        path = quote(name.strip("/") + "/")
+        if path not in intervals or not seconds.isdigit():
+            logger.error("Invalid --path-interval %s, the path must be selected", item)
+            sys.exit(1)
+        intervals[path] = int(seconds)
+    return intervals
+
+
+async def build_local_index(
+    localdb, conn, ready, manifest, media, paths, all_paths, full=False, workers=8
+):
+    async def scan(full):
+        with metrics.phase("local_db"):
+            # Always every selected path, the index forgets whatever is left out
+            await generate_localdb(
+                localdb, media, all_paths, full=full, workers=workers
+            )
+
+    local_amount = 0
+    if not full and manifest:
+        local_amount = await get_total_items_count(conn, paths)
+    # The incremental scan doesn't wait for the file list, the count only tells
+    # whether the index is too far off to be patched up
+    build = asyncio.create_task(scan(full))
+    try:
+        if local_amount > 0:
+            total_amount = await manifest
+            if total_amount > 0 and abs(total_amount - local_amount) > 1000:
+                logger.warning("The local DB isn't intact. regenerating...")
+                await stop_task(build)
+                build = asyncio.create_task(scan(True))
+        await build
+    finally:
+        await stop_task(build)
+    ready.set()
+
+
+async def stop_task(task):
+    # A no-op for a task that is done, an aborted sync doesn't leave it running
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def sync(args, paths, rescan=False, **kwargs):
+    media = kwargs["media"]
+    mirrors = kwargs["mirrors"]
+    listing_cache = kwargs["listing_cache"]
+    url = mirrors.base
+    manifest = None
+    if args.manifest:
+        # Counted by the sync that streams the list
+        manifest = asyncio.get_running_loop().create_future()
+    elif urlparse(url).path == "/" and args.purge:
+        # Counted in the background while the caches and the local DB get ready
+        manifest = asyncio.create_task(manifest_amount(mirrors, paths))
+    db_writer = None
+    db_session = None
+    index_session = None
+    resume = None
+    # Shards checkpoint their own crawl DBs, the one here only collects them
+    sharded = args.shards > 1 and len(paths) > 1 and not args.manifest
+    prune = False
+    # The file list crawls no folders, and a fallback crawl is better off full anyway
+    if listing_cache and args.full_crawl_days > 0 and not args.manifest:
+        age = time.time() - await last_full_crawl(listing_cache, paths)
+        prune = age < args.full_crawl_days * 86400
+        if not prune:
+            logger.info("Crawling every folder regardless of timestamps...")
+    local_index = None
+    index_ready = asyncio.Event()
+    # Open connections keep aiosqlite threads alive, an aborted sync must close them
+    async with contextlib.AsyncExitStack() as closing:
+        if args.db or args.purge:
+            localdb = os.path.join(kwargs["db_location"], ".localfiles.db")
+            tempdb = os.path.join(kwargs["db_location"], ".tempfiles.db")
+            index_session = await aiosqlite.connect(localdb)
+            # Callbacks run in reverse, so each DB is flushed before it is closed and
+            # the downloads are indexed after the crawl DB and the local DB are done
+            closing.push_async_callback(index_session.close)
+            closing.push_async_callback(index_downloads, index_session, tempdb)
+            await tune_db(index_session)
+            full = await create_index(index_session) or rescan
+            # Built while the crawl runs, which looks on disk until the index is whole
+            local_index = asyncio.create_task(
+                build_local_index(
+                    localdb,
+                    index_session,
+                    index_ready,
+                    manifest,
+                    media,
+                    paths,
+                    kwargs["all_paths"],
+                    full=full,
+                    workers=args.scan_workers,
+                )
+            )
+            closing.push_async_callback(stop_task, local_index)
+
+            db_session = await aiosqlite.connect(tempdb)
+            closing.push_async_callback(db_session.close)
+            await tune_db(db_session)
+            await create_table(db_session)
+            resume = await load_checkpoint(
+                db_session,
+                url,
+                paths,
+                resume=args.resume and not sharded,
+                max_age=args.resume_max_age,
+            )
+            db_writer = DBWriter(db_session)
+            closing.push_async_callback(db_writer.close)
+        logger.info("Crawling slowly...")
+        # What a shard process needs to know of the crawl, it opens everything else
+        shard_crawl = dict(
+            media=media,
+            nfo=args.nfo,
+            prune=prune,
+            crawlers=args.crawlers,
+            downloaders=args.downloaders,
+            order=args.order,
+        )
+        crawl = dict(
+            shard_crawl,
+            url=url,
+            session=kwargs["session"],
+            db_writer=db_writer,
+            semaphore=kwargs["semaphore"],
+            paths=paths,
+            index_session=index_session,
+            index_ready=index_ready,
+            listing_cache=listing_cache,
+            mirrors=mirrors,
+            resume=resume,
+            parse_pool=kwargs["parse_pool"],
+        )
+        with metrics.phase("crawl"):
+            if args.manifest:
+                logger.info("Syncing from the file list...")
+                complete = await sync_from_manifest(manifest=manifest, **crawl)
+            if not args.manifest or manifest.result() <= 0:
+                if args.manifest:
+                    logger.warning("The file list is unavailable, crawling instead...")
+                if sharded:
+                    complete = await crawl_in_shards(
+                        args,
+                        paths,
+                        shard_crawl,
+                        index_session,
+                        indexed=index_ready.is_set(),
+                        **kwargs,
+                    )
+                    for path in paths:
+                        db = shard_db(kwargs["db_location"], path)
+                        if os.path.exists(db):
+                            await merge_shard(db, db_session, listing_cache)
+                else:
+                    complete = await bulk_crawl_and_write(**crawl)
+        if db_writer and complete:
+            await db_writer.complete()
+        if not sharded:
+            mirrors.report()
+        if local_index:
+            # The downloads go into the index once it is whole, and purges need it too
+            await local_index
+    if listing_cache:
+        # A crawl that failed folders did not revalidate them, the next one stays full
+        full_crawl = complete and not prune and not args.manifest
+        if full_crawl and args.full_crawl_days > 0:
+            await mark_full_crawl(listing_cache, paths)
+        await listing_cache.commit()
+        logger.info(
+            "Listing cache: %d pruned, %d not modified, %d changed, %d new",
+            metrics["listing_pruned"],
+            metrics["listing_not_modified"],
+            metrics["listing_changed"],
+            metrics["listing_new"],
+        )
+    if args.purge and not complete:
+        # The crawl DB misses whatever was not listed, purging now would delete it
+        logger.error("The crawl is incomplete. Purges are skipped until it is resumed")
+        if manifest:
+            manifest.cancel()
+    elif args.purge:
+        total_amount = await manifest
+        with metrics.phase("purge"):
+            purged, folders = await purge_removed_files(
+                localdb, tempdb, media, total_amount, paths, workers=args.scan_workers
+            )
+            removed = await asyncio.to_thread(
+                remove_empty_parents, folders, media, paths
+            )
+        metrics["purged"] += purged
+        metrics["purged_folders"] += removed
+        logger.info(
+            "Purged %d files and %d empty folders in %.1fs",
+            purged,
+            removed,
+            metrics.phases["purge"],
+        )
+        os.remove(tempdb)
+    if sharded and complete:
+        # Kept until now, a run stopped before this point merges them again
+        for path in paths:
+            remove_db(shard_db(kwargs["db_location"], path))
+    logger.info(
+        "Checked %d files in %d folders: %d syscalls, %d index lookups, %.3fs on the event loop",
+        metrics["checked"],
+        metrics["checked_folders"],
+        metrics["syscalls"],
+        metrics["index_lookups"],
+        metrics["check_seconds"],
+    )
+    if listing_cache and complete:
+        # A crawl cut short counts few changes, it would pass for a quiet path
+        await record_sync(listing_cache, paths, metrics.changes)
+        await listing_cache.commit()
+    write_metrics(
+        args.metrics_file or os.path.join(kwargs["db_location"], ".metrics.json")
+    )
+    logger.info(
+        "Run took %.1fs: %d downloaded, %d skipped, %d failed, %.1f MiB",
+        time.time() - metrics.started,
+        metrics["downloaded"],
+        metrics["skipped"],
+        metrics["download_failed"],
+        metrics["bytes_downloaded"] / 1048576,
+    )
+    if metrics.first_download:
+        logger.info(
+            "The first download finished %.1fs after the start",
+            metrics.time_to_first_download(),
+        )
+    return complete
+
+
+async def run_daemon(args, **kwargs):
+    paths = kwargs["all_paths"]
+    listing_cache = kwargs["listing_cache"]
+    tiers = None
+    due_at = dict.fromkeys(paths, 0)
+    if args.tiers:
+        tiers = await path_tiers(args, paths, listing_cache)
+        if listing_cache:
+            # A restart picks up the schedule where the last process left it
+            intervals = parse_intervals(args, paths, tiers)
+            for path in paths:
+                due_at[path] = await last_synced(listing_cache, path) + intervals[path]
+    intervals = parse_intervals(args, paths, tiers)
+    if tiers:
+        log_tiers(tiers, intervals)
+    trigger = asyncio.Event()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, trigger.set)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    rescan = args.db
+    while not stopping.is_set():
+        if trigger.is_set():
+            trigger.clear()
+            logger.info("Sync requested by signal")
+            due = list(intervals)
+        else:
+            due = [path for path in intervals if due_at[path] <= time.time()]
+        if due:
+            if tiers:
+                due = by_tier(due, tiers)
+            logger.info("Syncing %s", ", ".join(unquote(path) for path in due))
+            cycle = asyncio.create_task(sync(args, due, rescan=rescan, **kwargs))
+            stop = asyncio.create_task(stopping.wait())
+            await asyncio.wait({cycle, stop}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if not cycle.done():
+                logger.warning("Stopping in the middle of a sync...")
+                cycle.cancel()
+                await asyncio.gather(cycle, return_exceptions=True)
+                break
+            complete = False
+            if cycle.exception():
+                logger.error("Sync failed: %r", cycle.exception())
+            else:
+                rescan = False
+                complete = cycle.result()
+            if tiers:
+                tiers = await path_tiers(args, paths, listing_cache)
+                intervals = parse_intervals(args, paths, tiers)
+                log_tiers(tiers, intervals)
+            for path in due:
+                interval = intervals[path]
+                if not complete:
+                    # Resumed from its checkpoint, not left for a whole cold interval
+                    interval = min(interval, SYNC_RETRY_SECONDS)
+                due_at[path] = time.time() + interval
+        wait = max(0, min(due_at.values()) - time.time())
+        logger.info("Next sync in %ds", wait)
+        waiters = [
+            asyncio.create_task(trigger.wait()),
+            asyncio.create_task(stopping.wait()),
+        ]
+        await asyncio.wait(waiters, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        # Every sync reports on its own, the Prometheus gauges show the latest one
+        metrics.reset()
+
+
+async def serve_until_stopped():
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    logger.info("Serving until stopped, add --daemon to sync this instance too")
+    await stopping.wait()
+
+
+async def main():
+    args = parse_args()
     if args.debug:
         logging.getLogger("emd").setLevel(logging.DEBUG)
     logging.info("*** xiaoya_emd version 1.6.8 ***")
@@ -659,82 +3666,112 @@ async def main():
             sys.exit(1)
         else:
             media = args.media.rstrip("/")
-    if not args.url:
-        url = pick_a_pool_member(s_pool)
-    else:
-        url = args.url
-    if urlparse(url).path != "/" and (args.purge or args.db):
-        logger.warning("--db or --purge only support in root path mode")
-        sys.exit(1)
-    if not url:
+    lag_watcher = asyncio.create_task(watch_loop_lag())
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = await start_metrics_server(args.metrics_port)
+    with metrics.phase("mirrors"):
+        if not args.url:
+            mirrors = await pick_pool_members(s_pool, args.mirror_count)
+        else:
+            mirrors = MirrorPool([Mirror(args.url, args.mirror_count)])
+    if not mirrors:
         logger.info(
             "No servers are reachable, please check your Internet connection..."
         )
         sys.exit(1)
-    if urlparse(url).path == "/":
-        total_amount = current_amount(url + ".scan.list.gz", media, paths)
-        logger.info("There are %d files in %s", total_amount, url)
-    semaphore = asyncio.Semaphore(args.count)
-    db_session = None
+    # Kept apart, the proxy mode syncs through a pool of its own
+    joining = mirrors.joining
+    if urlparse(mirrors.base).path != "/" and (
+        args.purge
+        or args.db
+        or args.manifest
+        or args.path_interval
+        or args.tiers
+        or args.shards > 1
+    ):
+        logger.warning(
+            "--db, --purge, --manifest, --path-interval, --tiers or --shards only support in root path mode"
+        )
+        sys.exit(1)
     if args.db or args.purge:
         assert sys.version_info >= (3, 12), "DB function requires Python 3.12+."
-        if args.location:
-            if test_db_folder(args.location) is True:
-                db_location = args.location.rstrip("/")
-            else:
-                sys.exit(1)
+    # Bad schedules fail here, before any DB is open
+    parse_tiers(args, paths)
+    parse_intervals(args, paths)
+    listing_cache = None
+    if args.location:
+        if test_db_folder(args.location) is True:
+            db_location = args.location.rstrip("/")
         else:
-            db_location = media
-        localdb = os.path.join(db_location, ".localfiles.db")
-        tempdb = os.path.join(db_location, ".tempfiles.db")
-        if not os.path.exists(localdb):
-            await generate_localdb(localdb, media, paths)
-        elif args.db:
-            os.remove(localdb)
-            await generate_localdb(localdb, media, paths)
-        else:
-            async with aiosqlite.connect(localdb) as local_session:
-                local_amount = await get_total_items_count(local_session)
-                if (
-                    local_amount > 0
-                    and total_amount > 0
-                    and abs(total_amount - local_amount) > 1000
-                ):
-                    logger.warning("The local DB isn't intact. regenerating...")
-                    await local_session.execute("DELETE FROM files")
-                    await local_session.commit()
-                    await generate_localdb(localdb, media, paths)
-
-        db_session = await aiosqlite.connect(tempdb)
-        await create_table(db_session)
-    logger.info("Crawling slowly...")
-    async with ClientSession(
-        connector=TCPConnector(ssl=False, limit=0, ttl_dns_cache=600),
-        timeout=aiohttp.ClientTimeout(total=36000),
-    ) as session:
-        await bulk_crawl_and_write(
-            url=url,
-            session=session,
-            db_session=db_session,
-            semaphore=semaphore,
-            media=media,
-            nfo=args.nfo,
-            paths=paths,
+            sys.exit(1)
+    else:
+        db_location = media
+    if args.cache:
+        listing_cache = await aiosqlite.connect(
+            os.path.join(db_location, ".listings.db")
         )
-    if db_session:
-        await db_session.commit()
-        await db_session.close()
-    if args.purge:
-        await purge_removed_files(localdb, tempdb, media, total_amount)
-        remove_empty_folders(paths, media)
-        os.remove(localdb)
-        if not args.all:
-            os.rename(tempdb, localdb)
-        else:
-            os.remove(tempdb)
+        await create_listing_cache(listing_cache)
+    parse_pool = None
+    if args.parse_workers:
+        parse_pool = create_parse_pool(args.parse_workers)
+    proxy = None
+    try:
+        # Shared by every sync, a daemon keeps the connections and mirror stats warm
+        async with ClientSession(
+            connector=TCPConnector(ssl=False, limit=0, ttl_dns_cache=600),
+            timeout=aiohttp.ClientTimeout(total=36000),
+        ) as session:
+            if args.proxy:
+                proxy = await start_proxy(
+                    args.proxy,
+                    session,
+                    mirrors,
+                    db_location,
+                    args.proxy_ttl,
+                    max_size=args.proxy_max_size * 1048576,
+                )
+                # This instance syncs through its own cache like any other on the LAN
+                mirrors = MirrorPool(
+                    [Mirror(f"http://127.0.0.1:{args.proxy}/", args.mirror_count)]
+                )
+            kwargs = dict(
+                session=session,
+                mirrors=mirrors,
+                media=media,
+                db_location=db_location,
+                listing_cache=listing_cache,
+                semaphore=asyncio.Semaphore(args.count),
+                all_paths=paths,
+                parse_pool=parse_pool,
+            )
+            if args.daemon:
+                await run_daemon(args, **kwargs)
+            elif args.proxy:
+                await serve_until_stopped()
+            else:
+                due = paths
+                if args.tiers:
+                    due = await due_paths(args, paths, listing_cache)
+                if due:
+                    await sync(args, due, rescan=args.db, **kwargs)
+                else:
+                    logger.info("No path is due for a sync yet")
+    finally:
+        if joining:
+            await stop_task(joining)
+        if proxy:
+            await stop_proxy(*proxy)
+        if listing_cache:
+            await listing_cache.close()
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
+    lag_watcher.cancel()
+    if metrics_server:
+        await metrics_server.cleanup()
     logger.info("Finished...")
 
 
 if __name__ == "__main__":
-    assert sys.version_info >= (3, 10), "Script requires Python 3.10+."
+    assert sys.version_info >= (3, 11), "Script requires Python 3.11+."
     asyncio.run(main())